@@ -0,0 +1,118 @@
+import concurrent.futures
+import asyncio
+import threading
+import json
+import node_client
+import codec
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Raised when a node can't be connected to, so the request never reached it
+if aiohttp is None:
+    ConnectionFailed = node_client.ConnectionFailed
+else:
+    ConnectionFailed = (node_client.ConnectionFailed, aiohttp.ClientConnectorError)
+
+# Number of connections kept open to every other node by the async client
+pool_size = 64
+# Without aiohttp, number of threads sending requests, and of threads only sending failure detection probes
+fallback_threads = 64
+probe_threads = 8
+
+# The event loop all asynchronous requests run on, in a thread of its own
+loop = None
+# aiohttp session of the loop, created on first use from inside the loop
+session = None
+loop_lock = threading.Lock()
+# Without aiohttp, where requests are sent from. Probes have threads of their
+# own, so requests waiting on a slow node can't hold up failure detection.
+executor = None
+probe_executor = None
+
+
+"""
+Answer of another node, with the parts of requests.Response the callers use
+"""
+class Response:
+    def __init__(self, status_code, body, headers):
+        self.status_code = status_code
+        self.content = body
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def start():
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+    return loop
+
+
+def get_session():
+    global session
+    if session is None:
+        connector = aiohttp.TCPConnector(limit_per_host=pool_size)
+        session = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+"""
+Send a request to another node without holding a thread while it is in flight
+
+Same arguments as node_client.request(), or a ready made 'body' with its
+'headers' instead of the payload. 'probe' is set by failure detection. Without
+aiohttp installed, the request is sent by node_client from a thread pool
+instead (see fallback_executor()). Raises if the node can't be reached.
+"""
+async def request(method, view, path, payload=None, timeout=None, body=None, headers=None, probe=False):
+    if timeout is None:
+        timeout = node_client.timeout
+    if aiohttp is None:
+        kwargs = {'timeout': timeout}
+        if body is not None:
+            kwargs['data'] = body
+            kwargs['headers'] = headers
+        response = await asyncio.get_running_loop().run_in_executor(
+            fallback_executor(probe), lambda: node_client.request(method, view, path, payload, **kwargs))
+        return Response(response.status_code, response.content, response.headers)
+
+    node_client.count_request(view)
+    if body is None and payload is not None:
+        body, headers = node_client.encode(view, payload)
+    headers = dict(headers or {}, accept=codec.accept())
+    try:
+        async with get_session().request(method, 'http://' + view + path, data=body, headers=headers,
+                                         timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            answer = Response(response.status, await response.read(), response.headers)
+    except Exception:
+        node_client.count_request(view, failed=True)
+        raise
+    node_client.learn(view, answer.headers)
+    return answer
+
+
+def fallback_executor(probe):
+    global executor, probe_executor
+    with loop_lock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=fallback_threads)
+            probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=probe_threads)
+    return probe_executor if probe else executor
+
+
+"""
+Run a coroutine on the event loop from any thread
+
+Returns a concurrent.futures.Future, so the caller can wait on it (or on many of
+them with concurrent.futures.as_completed) like on a thread pool.
+"""
+def submit(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, start())
@@ -0,0 +1,69 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Weight of the newest sample in the moving average of the latency
+alpha = 0.3
+# Latency recorded for a request that failed, so the view is avoided for a while (seconds)
+failure_penalty = 5
+
+# view -> number of requests in flight
+outstanding = dict()
+# view -> moving average of the latency of its requests (seconds)
+latency = dict()
+lock = threading.Lock()
+
+
+"""
+Cost of sending one more request to a view
+
+The requests already in flight, counting the new one, times the average time
+a request takes there. A view never used yet costs nothing, so it gets tried.
+"""
+def cost(view):
+    return (outstanding.get(view, 0) + 1) * latency.get(view, 0)
+
+
+"""
+Order the views a request can go to, the best first
+
+Only views last seen alive are considered, unless none of them is. The first
+view is the cheaper of two picked at random (power of two choices), which keeps
+a single fast view from taking every request. The others follow, cheapest
+first, to be tried if the first one fails.
+"""
+def order(views, alive):
+    candidates = [view for view in views if view in alive]
+    if len(candidates) == 0:
+        candidates = list(views)
+    if len(candidates) == 0:
+        return []
+    with lock:
+        first = min(random.sample(candidates, min(2, len(candidates))), key=cost)
+        rest = sorted((view for view in candidates if view != first), key=cost)
+    return [first] + rest
+
+
+# Keep track of a request to a view while it is in flight
+@contextmanager
+def track(view):
+    with lock:
+        outstanding[view] = outstanding.get(view, 0) + 1
+    start = time.monotonic()
+    elapsed = failure_penalty
+    try:
+        yield
+        elapsed = time.monotonic() - start
+    finally:
+        with lock:
+            outstanding[view] -= 1
+            if view in latency:
+                latency[view] = alpha * elapsed + (1 - alpha) * latency[view]
+            else:
+                latency[view] = elapsed
+
+
+def metrics():
+    with lock:
+        return {view: {'outstanding': outstanding.get(view, 0), 'latency': latency[view]} for view in latency}
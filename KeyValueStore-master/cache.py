@@ -0,0 +1,106 @@
+import collections
+import threading
+import time
+import causal
+
+# Number of keys kept, 0 turns the cache off (the default)
+capacity = 0
+# Time a value is served from the cache before it is fetched again (seconds)
+ttl = 30
+
+
+"""
+LRU cache of the values read from other shards
+
+Every write is replicated to all nodes, the ones of other shards included, so
+a node hears about every write made to a key it has cached and drops the value
+then. An invalidation is only done by a write newer than the cached value (see
+causal.is_newer()), so a replication message arriving late doesn't throw away
+a value that already reflects it. A node that misses a write (it was down, or
+the message was lost) still serves the old value for at most 'ttl' seconds.
+
+Replication to nodes outside the owning shard is asynchronous, and a message
+to a node that can't be reached waits in a hint queue, so another node can go
+on serving the old value after the write was acknowledged. Only a write
+forwarded to its shard by this node invalidates the key before the client gets
+its answer: a client reads its own writes back when it keeps using the same
+node. Since reads may be stale, the cache is off unless 'capacity' is set.
+
+A read that misses goes to the owning shard while writes keep arriving. If one
+of them arrives while the read is in flight, the answer may be older than the
+write, so the newest invalidation is remembered (as an entry with no value)
+until the read comes back, and an older answer isn't cached.
+"""
+class ReadCache:
+    def __init__(self):
+        # key -> [value, metadata, expiry], value is None when only the metadata is known
+        self.entries = collections.OrderedDict()
+        # key -> number of reads of it in flight
+        self.fetching = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale = 0
+
+    # Returns [value, metadata] if the key is cached, None if it has to be fetched
+    def lookup(self, key):
+        if capacity <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[2] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[:2]
+            self.misses += 1
+            self.fetching[key] = self.fetching.get(key, 0) + 1
+            return None
+
+    """
+    Give back the answer of a read that missed
+
+    'value' is None when the answer isn't cached (the key doesn't exist or the
+    read failed), so this only ends the read.
+    """
+    def fill(self, key, value, meta):
+        with self.lock:
+            count = self.fetching.get(key, 0) - 1
+            if count > 0:
+                self.fetching[key] = count
+            else:
+                self.fetching.pop(key, None)
+            if value is None or capacity <= 0:
+                return
+            entry = self.entries.get(key)
+            if entry is not None and causal.is_newer(entry[1], meta):
+                # A newer write arrived while the read was in flight
+                self.stale += 1
+                return
+            self.store(key, [value, meta, time.monotonic() + ttl])
+
+    # A write with metadata 'meta' was made to 'key'
+    def invalidate(self, key, meta):
+        if capacity <= 0:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if not causal.is_newer(meta, entry[1]):
+                    return
+                self.invalidations += 1
+            elif key not in self.fetching:
+                return
+            self.store(key, [None, meta, time.monotonic() + ttl])
+
+    # Must hold the lock
+    def store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > capacity:
+            self.entries.popitem(last=False)
+
+    def metrics(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations,
+                    'stale-reads': self.stale, 'size': len(self.entries), 'capacity': capacity}
@@ -0,0 +1,185 @@
+"""
+Vector clocks used as causal metadata
+
+A clock maps a node (its socket address) to a number of writes that originated
+on that node. Every write gets a dot, the node it was received on and its
+sequence number there. Its clock covers the clock the client sent (the writes
+it depends on) and every write the receiving node had seen, the dot included.
+Comparing two clocks costs one step per node, however many writes were made.
+
+Clients see clocks as opaque strings: "<node=count,node=count>".
+"""
+import threading
+
+# Every list of nodes a packed clock was made against, and the index of each
+orders = []
+order_ids = dict()
+orders_lock = threading.Lock()
+
+
+def decode(meta):
+    clock = dict()
+    if not meta:
+        return clock
+    for part in str(meta).strip('<>').split(','):
+        node, sep, count = part.rpartition('=')
+        # Anything else (like metadata from older versions) carries no dependency
+        if sep == '' or not count.isdigit():
+            continue
+        clock[node] = int(count)
+    return clock
+
+
+def encode(clock):
+    return ','.join('{}={}'.format(node, clock[node]) for node in sorted(clock))
+
+
+def merge(*clocks):
+    merged = dict()
+    for clock in clocks:
+        for node, count in clock.items():
+            if count > merged.get(node, 0):
+                merged[node] = count
+    return merged
+
+
+# Whether clock 'a' has seen everything clock 'b' has
+def descends(a, b):
+    for node, count in b.items():
+        if a.get(node, 0) < count:
+            return False
+    return True
+
+
+"""
+Whether a write with metadata 'meta' replaces one with metadata 'current'
+
+A write that causally follows the current one replaces it, one that precedes it
+doesn't. Concurrent writes are ordered by the total of their clocks and then by
+their encoding, so every replica keeps the same one.
+"""
+def is_newer(meta, current):
+    a = decode(meta)
+    b = decode(current)
+    if descends(b, a):
+        return False
+    if descends(a, b):
+        return True
+    return (sum(a.values()), encode(a)) > (sum(b.values()), encode(b))
+
+
+"""
+The writes a node has seen
+
+For every origin node, all its writes up to 'contiguous' plus the ones that
+arrived out of order past it. Once the missing ones arrive the extra dots fold
+into the contiguous count, so the history stays one number per node instead of
+growing with every write.
+"""
+class History:
+    def __init__(self):
+        self.contiguous = dict()
+        self.extra = dict()
+
+    def has(self, node, seq):
+        return seq <= self.contiguous.get(node, 0) or seq in self.extra.get(node, ())
+
+    # Whether every write 'clock' depends on has been seen
+    def covers(self, clock):
+        for node, count in clock.items():
+            if self.contiguous.get(node, 0) < count:
+                return False
+        return True
+
+    def next_seq(self, node):
+        return self.contiguous.get(node, 0) + 1
+
+    """
+    Merge what is known about the writes of 'node': everything up to
+    'contiguous' and the dots in 'extra'
+
+    Returns whether anything new was learned.
+    """
+    def merge(self, node, contiguous, extra):
+        before = self[node]
+        count = max(self.contiguous.get(node, 0), contiguous)
+        dots = self.extra.get(node, set()) | set(extra)
+        while count + 1 in dots:
+            count += 1
+        dots = {dot for dot in dots if dot > count}
+        self.contiguous[node] = count
+        if len(dots) > 0:
+            self.extra[node] = dots
+        else:
+            self.extra.pop(node, None)
+        return self[node] != before
+
+    def __getitem__(self, node):
+        return [self.contiguous.get(node, 0), sorted(self.extra.get(node, ()))]
+
+    def __len__(self):
+        return len(self.contiguous)
+
+    def to_json(self):
+        return {node: self[node] for node in self.contiguous}
+
+
+"""
+Compact form of metadata, for the entries a node holds in memory
+
+The metadata of an entry names every node of the cluster, so it grows with the
+cluster, and most entries name the same nodes in the same order. The names are
+kept once in 'orders' and an entry only holds the index of its order and the
+counts, as varints in a bytes object. For a 4 node cluster that is 38 bytes
+instead of about 120 for the string, and every node added costs one to three
+bytes instead of the length of its address.
+
+pack() returns anything it can't give back exactly (no clock, or not one it
+wrote) unchanged, and unpack() returns it as it is.
+"""
+def pack(meta):
+    if not isinstance(meta, str):
+        return meta
+    bracketed = meta.startswith('<') and meta.endswith('>')
+    body = meta[1:-1] if bracketed else meta
+    if body == '':
+        return meta
+    names = []
+    counts = []
+    for part in body.split(','):
+        node, sep, count = part.rpartition('=')
+        if sep == '' or not (count.isascii() and count.isdigit()) or (len(count) > 1 and count[0] == '0'):
+            return meta
+        names.append(node)
+        counts.append(int(count))
+    order = tuple(names)
+    with orders_lock:
+        order_id = order_ids.get(order)
+        if order_id is None:
+            order_id = len(orders)
+            orders.append(order)
+            order_ids[order] = order_id
+    packed = bytearray()
+    for number in [order_id * 2 + bracketed] + counts:
+        while number >= 0x80:
+            packed.append(number & 0x7f | 0x80)
+            number >>= 7
+        packed.append(number)
+    return bytes(packed)
+
+
+def unpack(packed):
+    if not isinstance(packed, bytes):
+        return packed
+    numbers = []
+    number = 0
+    shift = 0
+    for byte in packed:
+        number |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            numbers.append(number)
+            number = 0
+            shift = 0
+    body = ','.join('{}={}'.format(node, count) for node, count in zip(orders[numbers[0] // 2], numbers[1:]))
+    return '<' + body + '>' if numbers[0] % 2 else body
@@ -0,0 +1,190 @@
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Bodies at least this large are compressed, when the other end can decode them (bytes)
+compress_min = 1024
+# Compression levels, low ones since the data is compressed on every transfer
+zstd_level = 3
+zlib_level = 1
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+# One JSON value per line
+NDJSON = 'application/x-ndjson'
+# MessagePack values one after the other, the binary form of NDJSON
+MSGPACK_STREAM = 'application/x-msgpack-stream'
+
+# Compressions this node can decode, the one it prefers first. zlib always works.
+encodings = [name for name, module in (('zstd', zstandard), ('lz4', lz4)) if module is not None] + ['deflate']
+
+
+# Raised for a message in a format or compression this node can't decode
+class Unsupported(ValueError):
+    pass
+
+
+"""
+Encoding of the messages nodes send each other
+
+Internal endpoints (see main.internal_response()) answer in MessagePack when
+the request accepts it and msgpack is installed, in JSON otherwise, and every
+such answer lists the compressions the node decodes in Accept-Encoding. From
+those answers a node learns which of its peers take MessagePack and which
+compression, and encodes what it sends them accordingly (see
+node_client.encode()). Until it heard from a peer, or when either side lacks
+the modules, everything stays JSON and zlib, so nodes with and without the
+optional modules work together. The public API isn't affected, it answers in
+JSON whatever the request accepts.
+"""
+def accept():
+    return MSGPACK + ', ' + JSON if msgpack is not None else JSON
+
+# Same, for requests answered with a stream of values
+def accept_stream():
+    return MSGPACK_STREAM + ', ' + NDJSON if msgpack is not None else NDJSON
+
+# The names listed in an Accept or Accept-Encoding header, without their parameters
+def listed(header):
+    return [name.split(';')[0].strip() for name in (header or '').split(',')]
+
+# Whether a request with this Accept header takes MessagePack (or 'content_type')
+def takes_binary(accepted, content_type=MSGPACK):
+    return msgpack is not None and content_type in listed(accepted)
+
+# The compression to use with a peer that decodes 'accepted' (Accept-Encoding), None if none of ours
+def pick_encoding(accepted):
+    names = listed(accepted)
+    for name in encodings:
+        if name in names:
+            return name
+    return None
+
+
+def dumps(value, binary=False):
+    if binary:
+        return msgpack.packb(value, use_bin_type=True)
+    return json.dumps(value).encode()
+
+def loads(data, content_type=None):
+    if (content_type or '').startswith(MSGPACK):
+        if msgpack is None:
+            raise Unsupported(content_type)
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return json.loads(data)
+
+
+def compress(data, encoding):
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=zstd_level).compress(data)
+    if encoding == 'lz4' and lz4 is not None:
+        return lz4.frame.compress(data)
+    if encoding == 'deflate':
+        return zlib.compress(data, zlib_level)
+    raise Unsupported(encoding)
+
+def decompress(data, encoding):
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == 'lz4' and lz4 is not None:
+        return lz4.frame.decompress(data)
+    if encoding == 'deflate':
+        return zlib.decompress(data)
+    raise Unsupported(encoding)
+
+
+"""
+The body and headers of a message carrying 'data', already encoded by dumps()
+
+The body is compressed when it is large enough and 'encoding' isn't None.
+"""
+def wrap(data, binary, encoding):
+    headers = {'content-type': MSGPACK if binary else JSON}
+    if encoding is not None and len(data) >= compress_min:
+        data = compress(data, encoding)
+        headers['content-encoding'] = encoding
+    return data, headers
+
+# The value a message carries, raises Unsupported if it can't be decoded here
+def unwrap(body, content_type, encoding=None):
+    if encoding is not None and encoding != 'identity':
+        body = decompress(body, encoding)
+    return loads(body, content_type)
+
+
+# Compressor for a stream, with the compress() and flush() of zlib's
+class StreamCompressor:
+    def __init__(self, encoding):
+        self.header = None
+        if encoding == 'zstd':
+            self.compressor = zstandard.ZstdCompressor(level=zstd_level).compressobj()
+        elif encoding == 'lz4':
+            self.compressor = lz4.frame.LZ4FrameCompressor()
+            self.header = self.compressor.begin()
+        else:
+            self.compressor = zlib.compressobj(zlib_level)
+        self.encoding = encoding
+
+    def compress(self, data):
+        data = self.compressor.compress(data)
+        if self.encoding == 'lz4' and self.header is not None:
+            data, self.header = self.header + data, None
+        return data
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+"""
+Incremental decoder of a stream of values
+
+Takes the bytes of the stream as they arrive, in chunks of any size, and
+returns the values completed by every chunk.
+"""
+class StreamReader:
+    def __init__(self, content_type, encoding=None):
+        self.binary = (content_type or '').startswith(MSGPACK_STREAM)
+        if self.binary and msgpack is None:
+            raise Unsupported(content_type)
+        self.unpacker = msgpack.Unpacker(raw=False, strict_map_key=False) if self.binary else None
+        self.buffer = b''
+        if encoding is None or encoding == 'identity':
+            self.decompressor = None
+        elif encoding == 'zstd' and zstandard is not None:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding == 'lz4' and lz4 is not None:
+            self.decompressor = lz4.frame.LZ4FrameDecompressor()
+        elif encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            raise Unsupported(encoding)
+
+    def feed(self, data):
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        if self.binary:
+            self.unpacker.feed(data)
+            return list(self.unpacker)
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        return [json.loads(line) for line in lines if line]
+
+# One value of a stream, as written by the sender
+def stream_item(value, binary=False):
+    if binary:
+        return msgpack.packb(value, use_bin_type=True)
+    return json.dumps(value).encode() + b'\n'
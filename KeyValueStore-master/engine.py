@@ -0,0 +1,448 @@
+import os
+import sys
+import json
+import heapq
+import bisect
+import hashlib
+import tempfile
+import threading
+import collections
+import itertools
+import causal
+
+# Number of entries the memtable holds before it is written out as an SSTable
+memtable_limit = 20000
+# Number of SSTables that triggers merging them all into one
+compaction_trigger = 4
+# One in how many entries of an SSTable is kept in its in-memory index
+index_interval = 16
+# Bits of bloom filter per key, about 1% false positives with 7 hashes
+bloom_bits_per_key = 10
+bloom_hashes = 7
+# Number of entries looked at to estimate the memory the entries take
+memory_sample = 1000
+# Bytes read at a time when going through a whole table
+read_chunk = 65536
+
+
+"""
+An entry of the KVS, a value and its causal metadata
+
+A tuple with named fields and no per-instance dict, which takes 56 bytes where
+the [value, metadata] lists it replaces took 72. Being a tuple, it is still
+written as [value, metadata] in JSON, so nothing changes on the wire or on disk.
+"""
+Entry = collections.namedtuple('Entry', ['value', 'meta'])
+
+
+# Estimate the memory held by the 'count' entries of a dict from the first few
+def estimate_entries(entries, count):
+    # Taken in one go, so a concurrent write can't change the dict under us
+    sample = [(key, entry) for key, entry in list(itertools.islice(entries.items(), memory_sample)) if entry is not None]
+    if len(sample) == 0:
+        return 0
+    size = 0
+    for key, entry in sample:
+        size += sys.getsizeof(key) + sys.getsizeof(entry) + sum(sys.getsizeof(field) for field in entry)
+    return size * count // len(sample)
+
+
+"""
+Storage engines hold the KVS of a node: key -> Entry
+
+They all behave like a dict (get, [], in, pop, len, keys, items) so the rest of
+the node doesn't care which one is used. On top of that:
+  checkpoint() - called while no write can happen when a snapshot is taken,
+                 returns the entries to put in the snapshot, or None when the
+                 engine keeps them on disk itself
+  sync()       - called after checkpoint(), returns once everything written
+                 before it is safe without the snapshot
+  memory()     - estimate of the memory the engine takes (bytes)
+  stream()     - iterates over the entries without copying them, safe while
+                 they are being written
+"""
+
+
+"""
+Holds every entry in memory
+
+An entry is kept as a (value, packed metadata) tuple (see causal.pack()), and
+made an Entry again when it is read.
+"""
+class MemoryEngine:
+    def __init__(self):
+        self.entries = dict()
+
+    def get(self, key, default=None):
+        packed = self.entries.get(key)
+        if packed is None:
+            return default
+        return Entry(packed[0], causal.unpack(packed[1]))
+
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __setitem__(self, key, entry):
+        self.entries[key] = (entry[0], causal.pack(entry[1]))
+
+    def pop(self, key, default=None):
+        packed = self.entries.pop(key, None)
+        if packed is None:
+            return default
+        return Entry(packed[0], causal.unpack(packed[1]))
+
+    def keys(self):
+        return self.entries.keys()
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def items(self):
+        for key, packed in list(self.entries.items()):
+            yield key, Entry(packed[0], causal.unpack(packed[1]))
+
+    def checkpoint(self):
+        return dict(self.items())
+
+    # Only the keys are copied, taken in one go, each entry is read when its turn comes
+    def stream(self):
+        for key in list(self.entries.keys()):
+            entry = self.get(key)
+            if entry is not None:
+                yield key, entry
+
+    def sync(self):
+        pass
+
+    def memory(self):
+        return sys.getsizeof(self.entries) + estimate_entries(self.entries, len(self.entries))
+
+
+"""
+Bloom filter, answers whether a key may be in a set without false negatives
+"""
+class BloomFilter:
+    def __init__(self, expected):
+        self.size = max(expected * bloom_bits_per_key, 64)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        h = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        a = int.from_bytes(h[:8], 'big')
+        b = int.from_bytes(h[8:], 'big') | 1
+        return [(a + i * b) % self.size for i in range(bloom_hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p // 8] |= 1 << (p % 8)
+
+    def may_contain(self, key):
+        for p in self.positions(key):
+            if not self.bits[p // 8] & (1 << (p % 8)):
+                return False
+        return True
+
+
+"""
+Sorted string table, an immutable file of entries sorted by key
+
+Every line is a JSON [key, entry] pair, entry being None for a deleted key.
+Only every 'index_interval'-th key is kept in memory along with its offset, so
+a lookup reads a single small block of the file. The index and the bloom filter
+are rebuilt with one scan when the table is opened.
+
+Everything is read from the file opened then. A compaction removes the file
+of a table it merged, but whoever still goes through the table keeps reading
+it until they are done with it.
+"""
+class SSTable:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.index_keys = []
+        self.index_offsets = []
+        keys = []
+        offset = 0
+        for line in self.file:
+            key = json.loads(line)[0]
+            if len(keys) % index_interval == 0:
+                self.index_keys.append(key)
+                self.index_offsets.append(offset)
+            keys.append(key)
+            offset += len(line)
+        self.bloom = BloomFilter(len(keys))
+        for key in keys:
+            self.bloom.add(key)
+
+    """
+    Write 'items', sorted (key, entry) pairs, as a new table at 'path'
+
+    The table is written under a temporary name and renamed once it is on disk,
+    so a table that exists is always complete.
+    """
+    @staticmethod
+    def write(path, items):
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for key, entry in items:
+                f.write(json.dumps([key, entry]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        return SSTable(path)
+
+    # Returns (found, entry), entry being None when the key was deleted
+    def lookup(self, key):
+        if not self.bloom.may_contain(key):
+            return False, None
+        block = bisect.bisect_right(self.index_keys, key) - 1
+        if block < 0:
+            return False, None
+        start = self.index_offsets[block]
+        end = self.index_offsets[block + 1] if block + 1 < len(self.index_offsets) else self.size
+        for line in os.pread(self.file.fileno(), end - start, start).splitlines():
+            pair = json.loads(line)
+            if pair[0] == key:
+                return True, pair[1]
+        return False, None
+
+    def items(self):
+        offset = 0
+        rest = b''
+        while offset < self.size:
+            chunk = os.pread(self.file.fileno(), min(read_chunk, self.size - offset), offset)
+            if len(chunk) == 0:
+                break
+            offset += len(chunk)
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                pair = json.loads(line)
+                yield pair[0], pair[1]
+        if len(rest) > 0:
+            pair = json.loads(rest)
+            yield pair[0], pair[1]
+
+    def __del__(self):
+        self.file.close()
+
+
+def tagged(source, age):
+    for key, entry in source:
+        yield key, age, entry
+
+
+"""
+Merge sorted (key, entry) sources, newest first, into the live entries
+
+For a key found in several sources the newest entry wins, and keys whose
+newest entry is a deletion are left out.
+"""
+def merge_sources(sources):
+    last = None
+    for key, age, entry in heapq.merge(*[tagged(source, age) for age, source in enumerate(sources)]):
+        if key == last:
+            continue
+        last = key
+        if entry is not None:
+            yield key, entry
+
+
+"""
+Log-structured merge tree engine
+
+Writes go to an in-memory memtable. A full memtable is frozen and written out
+as an SSTable by a background thread, which then merges the tables together
+once there are 'compaction_trigger' of them, dropping deleted and overwritten
+entries. Lookups go from the newest data to the oldest: memtable, frozen
+memtables, then the tables, skipping every table whose bloom filter rules the
+key out. Only the memtables and the table indexes live in memory.
+
+Nothing in the memtable survives a crash, the write-ahead log takes care of
+that when the node has a data directory.
+"""
+class LSMEngine:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.memtable = {}
+        # Memtables waiting to be written out, newest first
+        self.frozen = []
+        # Newest first
+        self.tables = []
+        self.next_table = 1
+        numbers = sorted(int(name[4:-4]) for name in os.listdir(directory) if name.startswith('sst-') and name.endswith('.sst'))
+        for number in numbers:
+            self.tables.insert(0, SSTable(self.table_path(number)))
+            self.next_table = number + 1
+        self.count = sum(1 for key in self.keys())
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        flusher = threading.Thread(target=self.flush_forever, daemon=True)
+        flusher.start()
+
+    def table_path(self, number):
+        return os.path.join(self.directory, 'sst-{:08d}.sst'.format(number))
+
+    # Returns (found, entry), entry being None when the key was deleted
+    def lookup(self, key):
+        # Read once, freeze() may swap in a new memtable at any time
+        memtable = self.memtable
+        if key in memtable:
+            return True, memtable[key]
+        for memtable in self.frozen[:]:
+            if key in memtable:
+                return True, memtable[key]
+        for table in self.tables[:]:
+            found, entry = table.lookup(key)
+            if found:
+                return True, entry
+        return False, None
+
+    def get(self, key, default=None):
+        found, entry = self.lookup(key)
+        if not found or entry is None:
+            return default
+        return entry
+
+    def __getitem__(self, key):
+        entry = self.get(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def write(self, key, entry):
+        existed = key in self
+        self.memtable[key] = entry
+        if entry is not None and not existed:
+            self.count += 1
+        elif entry is None and existed:
+            self.count -= 1
+        if len(self.memtable) >= memtable_limit:
+            self.freeze()
+
+    def __setitem__(self, key, entry):
+        self.write(key, entry)
+
+    def pop(self, key, default=None):
+        entry = self.get(key)
+        if entry is None:
+            return default
+        self.write(key, None)
+        return entry
+
+    def freeze(self):
+        with self.cond:
+            if len(self.memtable) == 0:
+                return
+            self.frozen.insert(0, self.memtable)
+            self.memtable = {}
+            self.cond.notify_all()
+
+    """
+    Iterate over the live entries in key order
+
+    Every source is sorted, so they are merged in one pass. The newest source
+    comes first in the merge, which picks its entry and skips the older ones.
+    """
+    def items(self):
+        sources = [sorted(self.memtable.items())]
+        for memtable in self.frozen[:]:
+            sources.append(sorted(memtable.items()))
+        for table in self.tables[:]:
+            sources.append(table.items())
+        return merge_sources(sources)
+
+    def keys(self):
+        for key, entry in self.items():
+            yield key
+
+    def __iter__(self):
+        return self.keys()
+
+    # The tables never change and items() sorts a copy of the memtables
+    def stream(self):
+        return self.items()
+
+    def checkpoint(self):
+        self.freeze()
+        return None
+
+    def sync(self):
+        with self.cond:
+            self.cond.wait_for(lambda: len(self.frozen) == 0)
+
+    # Only the memtables, the table indexes and the bloom filters are in memory
+    def memory(self):
+        size = 0
+        for memtable in [self.memtable] + self.frozen[:]:
+            size += sys.getsizeof(memtable) + estimate_entries(memtable, len(memtable))
+        for table in self.tables[:]:
+            size += sys.getsizeof(table.bloom.bits) + sum(sys.getsizeof(key) for key in table.index_keys)
+            size += sys.getsizeof(table.index_keys) + sys.getsizeof(table.index_offsets)
+        return size
+
+    def flush_forever(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.frozen) > 0)
+                memtable = self.frozen[-1]
+            try:
+                table = SSTable.write(self.table_path(self.next_table), sorted(memtable.items()))
+                self.next_table += 1
+                with self.cond:
+                    self.tables.insert(0, table)
+                    self.frozen.remove(memtable)
+                    self.cond.notify_all()
+                if len(self.tables) >= compaction_trigger:
+                    self.compact()
+            except Exception as e:
+                print("Could not write an SSTable: {}".format(e), file=sys.stderr)
+
+    """
+    Merge every table into a single one
+
+    The tables are only ever added by this thread, so none can show up while
+    they are merged. The merged table holds everything there is on disk, which
+    means deleted entries can be dropped for good.
+    """
+    def compact(self):
+        merging = self.tables[:]
+        merged = merge_sources([table.items() for table in merging])
+        table = SSTable.write(self.table_path(self.next_table), merged)
+        self.next_table += 1
+        with self.cond:
+            self.tables = [table]
+        for old in merging:
+            os.remove(old.path)
+
+
+"""
+Open the engine named 'kind'
+
+The LSM engine keeps its tables under 'directory', or in a temporary directory
+when the node has no data directory.
+"""
+def open_engine(kind, directory=None):
+    if kind == 'memory':
+        return MemoryEngine()
+    if kind == 'lsm':
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='kvs-')
+        return LSMEngine(os.path.join(directory, 'lsm'))
+    raise ValueError("Unknown storage engine '{}'".format(kind))
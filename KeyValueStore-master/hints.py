@@ -0,0 +1,92 @@
+import collections
+import threading
+import time
+import sys
+import node_client
+import views
+
+# Number of writes kept for one node that is down, the oldest are dropped past it
+max_hints = 100000
+# Number of writes replayed in one request
+replay_batch = 500
+# Time to wait between checks for nodes that came back (seconds)
+replay_interval = 0.5
+# Time to wait for a node to apply a batch of writes (seconds)
+replay_timeout = 10
+
+BATCH_PATH = '/selfish-key-value-store-batch'
+
+# view -> writes it missed, in the form of the ops of a batch write, oldest first
+pending = dict()
+# view -> number of writes dropped because there were too many
+dropped = dict()
+replayed = 0
+lock = threading.Lock()
+
+
+"""
+Hinted handoff: the writes a node missed while it was down
+
+A replicated write (see replication.replicate()) that a node never
+acknowledged is kept here as a hint instead of being lost. Once the failure
+detector (see views.verify_views()) sees the node alive again, its hints are
+replayed in order, 'replay_batch' at a time, through the batch endpoint. A node
+coming back this way only receives the writes it missed, however many keys
+there are.
+
+Hints live in memory and are bounded, anything they miss (hints dropped, or
+lost with the node holding them) is left to the background synchronization.
+"""
+def add(view, ops):
+    with lock:
+        queue = pending.setdefault(view, collections.deque())
+        queue.extend(ops)
+        while len(queue) > max_hints:
+            queue.popleft()
+            dropped[view] = dropped.get(view, 0) + 1
+
+
+"""
+Send the hints of 'view' to it, a batch at a time
+
+A batch is only removed once the node applied it. Replaying a write twice does
+no harm, the node keeps the newer entry. Returns whether every hint went through.
+"""
+def replay(view):
+    global replayed
+    while True:
+        with lock:
+            queue = pending.get(view)
+            if queue is None or len(queue) == 0:
+                pending.pop(view, None)
+                return True
+            batch = [queue[i] for i in range(min(replay_batch, len(queue)))]
+        try:
+            response = node_client.put(view, BATCH_PATH, {'ops': batch}, timeout=replay_timeout)
+            if response.status_code != 200:
+                return False
+        except Exception as e:
+            return False
+        with lock:
+            # Hints may have been dropped from the front while the batch was out
+            for op in batch:
+                if len(queue) > 0 and queue[0] is op:
+                    queue.popleft()
+            replayed += len(batch)
+
+def replay_forever():
+    while True:
+        time.sleep(replay_interval)
+        for view in list(pending):
+            if view not in views.known_views:
+                # The view was removed, it won't come back
+                with lock:
+                    pending.pop(view, None)
+            elif view in views.alive_views:
+                if not replay(view):
+                    print("Could not replay the writes '{}' missed".format(view), file=sys.stderr)
+
+def metrics():
+    with lock:
+        return {'pending': {view: len(queue) for view, queue in pending.items()},
+                'dropped': dict(dropped), 'replayed': replayed}
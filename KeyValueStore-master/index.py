@@ -0,0 +1,104 @@
+import bisect
+import threading
+
+# Number of keys a chunk is split back to once it grows to twice as many
+chunk_size = 1000
+# Most keys a scan returns at once
+max_limit = 1000
+
+
+"""
+Ordered index over the live keys of a node
+
+The keys are kept sorted in chunks of about 'chunk_size', along with the last
+key of every chunk. Finding a key is a binary search over the chunk ends then
+one over the chunk, and adding or removing one only shifts the keys of its
+chunk, so the index stays cheap to update with millions of keys. A scan
+starts at the first key in range and walks the chunks in order.
+"""
+class OrderedIndex:
+    def __init__(self):
+        self.chunks = []
+        self.maxes = []
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        with self.lock:
+            if len(self.chunks) == 0:
+                self.chunks.append([key])
+                self.maxes.append(key)
+                self.size += 1
+                return
+            i = min(bisect.bisect_left(self.maxes, key), len(self.maxes) - 1)
+            chunk = self.chunks[i]
+            j = bisect.bisect_left(chunk, key)
+            if j < len(chunk) and chunk[j] == key:
+                return
+            chunk.insert(j, key)
+            self.maxes[i] = chunk[-1]
+            self.size += 1
+            if len(chunk) >= 2 * chunk_size:
+                self.chunks[i:i + 1] = [chunk[:chunk_size], chunk[chunk_size:]]
+                self.maxes[i:i + 1] = [chunk[chunk_size - 1], chunk[-1]]
+
+    def discard(self, key):
+        with self.lock:
+            i = bisect.bisect_left(self.maxes, key)
+            if i == len(self.maxes):
+                return
+            chunk = self.chunks[i]
+            j = bisect.bisect_left(chunk, key)
+            if j == len(chunk) or chunk[j] != key:
+                return
+            del chunk[j]
+            self.size -= 1
+            if len(chunk) == 0:
+                del self.chunks[i]
+                del self.maxes[i]
+            else:
+                self.maxes[i] = chunk[-1]
+
+    def rebuild(self, keys):
+        with self.lock:
+            self.chunks = []
+            self.maxes = []
+            self.size = 0
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return self.size
+
+    # Every key in order, copied so they can be gone through without the lock
+    def keys(self):
+        with self.lock:
+            return [key for chunk in self.chunks for key in chunk]
+
+    """
+    Keys starting with 'prefix', from 'start' (included) to 'end' (excluded),
+    in order, and past 'after' when it is given (where the last page stopped)
+
+    Returns at most 'limit' keys.
+    """
+    def scan(self, prefix='', start=None, end=None, after=None, limit=100):
+        low = max(prefix, start or '')
+        with self.lock:
+            if after is not None and after >= low:
+                i = bisect.bisect_right(self.maxes, after)
+                j = bisect.bisect_right(self.chunks[i], after) if i < len(self.chunks) else 0
+            else:
+                i = bisect.bisect_left(self.maxes, low)
+                j = bisect.bisect_left(self.chunks[i], low) if i < len(self.chunks) else 0
+            keys = []
+            while i < len(self.chunks) and len(keys) < limit:
+                chunk = self.chunks[i]
+                while j < len(chunk) and len(keys) < limit:
+                    key = chunk[j]
+                    if not key.startswith(prefix) or (end is not None and key >= end):
+                        return keys
+                    keys.append(key)
+                    j += 1
+                i += 1
+                j = 0
+            return keys
@@ -0,0 +1,154 @@
+import itertools
+import json
+import time
+import requests
+import causal
+import partitioner
+
+# Standard headers when dealing with posting data
+HEADERS = {'content-type': 'application/json'}
+# Time reads of a shard go to the member that took the last write to it, while
+# the write reaches the other replicas (seconds)
+stick_time = 2
+
+
+# Raised when a node refuses a request, carries its status, message and whole answer
+class ClientError(Exception):
+    def __init__(self, status_code, message, answer=None):
+        super().__init__("{} {}".format(status_code, message))
+        self.status_code = status_code
+        self.message = message
+        self.answer = answer
+
+
+"""
+Client for the key-value store that talks straight to the shard owning a key
+
+The shard layout is fetched from any of the nodes given and cached. Keys are
+mapped to shards locally with the same partitioner the nodes use, so every
+request goes to a member of the owning shard without the extra forwarding hop.
+Requests for a shard are spread over its members in turn, and a member that
+can't be reached is skipped. The causal metadata of every answer is merged
+into the metadata sent with the next request, so the writes of a client are
+ordered. A write may be acknowledged before every replica has it, so for
+'stick_time' after a write the reads of its shard go to the member that took
+it, and the client reads its writes back.
+
+When a node answers with an X-Shard-Id that isn't the shard the client
+expected, the layout changed (a reshard or a new member) and it is fetched
+again. The request itself was already forwarded to the right shard by the node.
+
+Example:
+    client = KVSClient(['10.10.0.2:8085', '10.10.0.3:8085'])
+    client.put('x', '1')
+    client.get('x')  # '1'
+"""
+class KVSClient:
+    def __init__(self, nodes, partitioner_kind='ring', timeout=5):
+        self.nodes = list(nodes)
+        self.partitioner_kind = partitioner_kind
+        self.timeout = timeout
+        self.session = requests.Session()
+        # shard ID -> members
+        self.shards = {}
+        # shard ID -> iterator going round its members
+        self.turns = {}
+        self.partitioner = None
+        self.clock = {}
+        # shard ID -> (member that took the last write, time reads stop going to it)
+        self.written = {}
+
+    def causal_metadata(self):
+        return '<' + causal.encode(self.clock) + '>' if len(self.clock) > 0 else ''
+
+    def note_metadata(self, meta):
+        if meta:
+            self.clock = causal.merge(self.clock, causal.decode(meta))
+
+    # Fetch the shard layout from the first node that answers
+    def refresh(self):
+        for node in self.nodes:
+            try:
+                ids = self.session.get('http://' + node + '/key-value-store-shard/shard-ids', timeout=self.timeout).json()['shard-ids']
+                shards = {}
+                for shard in ids:
+                    response = self.session.get('http://' + node + '/key-value-store-shard/shard-id-members/' + str(shard), timeout=self.timeout)
+                    shards[int(shard)] = response.json()['shard-id-members']
+            except Exception as e:
+                continue
+            self.shards = shards
+            self.partitioner = partitioner.partitioners[self.partitioner_kind](tuple(sorted(shards)))
+            self.turns = {shard: itertools.cycle(members) for shard, members in shards.items() if len(members) > 0}
+            # Any member is a good place to ask next time
+            self.nodes = list(dict.fromkeys([m for members in shards.values() for m in members] + self.nodes))
+            return
+        raise ConnectionError("None of the nodes could be reached")
+
+    def shard_of(self, key):
+        if self.partitioner is None:
+            self.refresh()
+        return self.partitioner.find(key)
+
+    """
+    Send a request for 'key' to the shard owning it
+
+    Each member of the shard is tried once, starting from the next one in turn,
+    or for a read from the member that just took a write. Returns the response
+    of the first member that answers.
+    """
+    def request(self, method, key, payload=None):
+        shard = self.shard_of(key)
+        members = self.shards.get(shard, [])
+        written = self.written.get(shard)
+        if method != 'GET' or written is None or written[1] < time.monotonic() or written[0] not in members:
+            written = None
+        for i in range(len(members)):
+            member = written[0] if i == 0 and written is not None else next(self.turns[shard])
+            kwargs = {'timeout': self.timeout}
+            if payload is not None:
+                kwargs['headers'] = HEADERS
+                kwargs['data'] = json.dumps(payload)
+            try:
+                response = self.session.request(method, 'http://' + member + '/key-value-store/' + key, **kwargs)
+            except requests.exceptions.ConnectionError:
+                continue
+            if response.headers.get('X-Shard-Id') not in (None, str(shard)):
+                self.refresh()
+            elif method != 'GET':
+                self.written[shard] = (member, time.monotonic() + stick_time)
+            return response
+        # Every member is gone, the layout must have changed
+        self.refresh()
+        raise ConnectionError("No member of shard {} could be reached".format(shard))
+
+    """
+    The answer of a node that took a request, its metadata merged into ours
+
+    Raises ClientError when the node refused it or couldn't carry it out (e.g.
+    a write it depends on isn't there yet, or the shard is unavailable). The
+    metadata of such an answer isn't merged.
+    """
+    def answer(self, response):
+        try:
+            answer = response.json()
+        except ValueError:
+            raise ClientError(response.status_code, response.text)
+        if not 200 <= response.status_code < 300:
+            raise ClientError(response.status_code, answer.get('message') or answer.get('error'), answer)
+        self.note_metadata(answer.get('causal-metadata'))
+        return answer
+
+    # Returns the value of 'key', None if it doesn't exist
+    def get(self, key):
+        response = self.request('GET', key)
+        if response.status_code == 404:
+            return None
+        return self.answer(response)['value']
+
+    def put(self, key, value):
+        response = self.request('PUT', key, {'value': value, 'causal-metadata': self.causal_metadata()})
+        return response.status_code, self.answer(response)
+
+    def delete(self, key):
+        response = self.request('DELETE', key, {'causal-metadata': self.causal_metadata()})
+        return response.status_code, self.answer(response)
@@ -0,0 +1,19 @@
+import threading
+
+# Number of locks the keys are spread over
+stripes = 256
+
+
+"""
+A fixed set of locks shared by all keys
+
+Every key maps to one of the locks by its hash, so writes to different keys
+rarely wait on each other, while the number of locks stays the same however
+many keys there are.
+"""
+class StripedLock:
+    def __init__(self, count=None):
+        self.locks = [threading.Lock() for i in range(count or stripes)]
+
+    def for_key(self, key):
+        return self.locks[hash(key) % len(self.locks)]
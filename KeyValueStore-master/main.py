@@ -1,14 +1,81 @@
-from flask import Flask, request, make_response, jsonify
+from flask import Flask, Response, request, make_response, jsonify
 import views
+import merkle
+import replication
+import node_client
+import partitioner
+import storage
+import engine
+import causal
+import serve
+import aio
+import locks
+import balancer
+import cache
+import hints
+import index
+import codec
 import threading
+import collections
+import concurrent.futures
+import json
+import heapq
+import urllib.parse
+import time
 import os
 import sys
-import json, requests
 
 app = Flask(__name__)
 class vars:
-	kvs_dict = {}
-	history_dict = {}
+	# key -> Entry (value, metadata), held by a storage engine (see engine.py)
+	kvs_dict = engine.MemoryEngine()
+	# The writes this node has seen, what causal metadata is checked against
+	history = causal.History()
+	# Local change counter, bumped every time this node writes an entry
+	version = 0
+	# key (or node, for the history) -> version it last changed at, kept in version order
+	kvs_changes = {}
+	history_changes = {}
+	# peer -> highest version we have already pulled from that peer
+	watermarks = {}
+	# Serializes the writes to any one key, see store_if_newer()
+	key_locks = locks.StripedLock()
+	# Guards the counter and the change logs
+	change_lock = threading.Lock()
+	# Notified whenever the history grows
+	history_cond = threading.Condition(change_lock)
+	# Time a write waits for the metadata it depends on to arrive (seconds)
+	dependency_wait = 2
+	# Merkle tree over the local KVS, used to find diverging keys
+	tree = merkle.MerkleTree()
+	# Time to wait between background synchronization rounds (seconds)
+	sync_interval = 1
+	# Every how many rounds the Merkle trees are compared as well
+	merkle_rounds = 30
+	# Progress of the reshard this node is taking part in
+	migration = {}
+	# Time to wait for the shard a client request was forwarded to (seconds)
+	forward_timeout = 30
+	# Number of keys sent in one request when migrating keys to another shard
+	migration_chunk = 500
+	# Size of the chunks a streamed state transfer is sent in (bytes)
+	stream_chunk = 65536
+	# Number of streamed entries merged at once
+	stream_batch = 500
+	# Write-ahead log of every change, None when the state only lives in memory
+	wal = None
+	# Time to wait between checks for whether the log needs compacting (seconds)
+	snapshot_interval = 5
+	# Values read from other shards, see cache.py
+	read_cache = cache.ReadCache()
+	# The live keys in order, for scans (see index.py)
+	key_index = index.OrderedIndex()
+	# key -> time its tombstone expires, kept in expiry order
+	tombstones = collections.OrderedDict()
+	# Time a deleted key is remembered, long enough for every replica to hear about the delete (seconds)
+	tombstone_ttl = 3600
+	# Time to wait between checks for expired tombstones (seconds)
+	tombstone_check = 10
 
 ###################
 # VIEW OPERATIONS #
@@ -36,11 +103,10 @@ Will then check if the requested view exists or not. If it does not, it will ret
 """
 @app.route('/key-value-store-view', methods=['DELETE'])
 def delete_view():
-	json_value = request.get_json()
+	json_value = read_body()
 	if json_value is not None and 'socket-address' in json_value:
 		view_to_delete = json_value['socket-address']
-		if view_to_delete in views.known_views: # Handle the case where the view is in the list
-			views.known_views.remove(view_to_delete)
+		if views.remove_view(view_to_delete): # Handle the case where the view is in the list
 			json_response = jsonify(message="Replica deleted successfully from the view")
 			response = make_response(json_response, 200)
 		else: # Handle the case where the view does not exist
@@ -51,14 +117,34 @@ def delete_view():
 		response = make_response(json_response, 500)
 	return response
 
+"""
+Handle the messages of the membership protocol, see views.verify_views()
+
+A ping is answered right away, a ping request is answered once the target
+answered the ping sent on behalf of the requester (or didn't in time). Both
+carry the news of the sender, and the answers the news of this node.
+"""
+@app.route('/gossip-ping', methods=['PUT'])
+def gossip_ping():
+	return internal_response(views.handle_ping(read_body()))
+
+@app.route('/gossip-ping-req', methods=['PUT'])
+def gossip_ping_req():
+	return internal_response(views.handle_ping_req(read_body()))
+
+# Report the state of every view as this node sees it
+@app.route('/gossip-members', methods=['GET'])
+def gossip_members():
+	json_response = jsonify(message="Members retrieved successfully", members=views.membership())
+	response = make_response(json_response, 200)
+	return response
+
 @app.route('/key-value-store-view-new', methods=['PUT'])
 def new_view():
-	json_value = request.get_json()
+	json_value = read_body()
 	if json_value is not None and 'socket-address' in json_value:
 		new_view = json_value['socket-address']
-		if new_view not in views.known_views: # Handle the case where the view is in the list
-			views.known_views.append(new_view)
-			views.alive_views.append(new_view)
+		if views.add_view(new_view): # Handle the case where the view is in the list
 			json_response = jsonify(message="Replica added successfully from the view")
 			response = make_response(json_response, 200)
 		else: # Handle the case where the view does not exist
@@ -81,12 +167,10 @@ return 201 along with the desired information.
 """
 @app.route('/key-value-store-view', methods=['PUT'])
 def put_view():
-	json_value = request.get_json()
+	json_value = read_body()
 	if json_value is not None and 'socket-address' in json_value:
 		view_to_add = json_value['socket-address']
-		if view_to_add not in views.known_views: # Handle the case where we added the view
-			views.known_views.append(view_to_add)
-			views.alive_views.append(view_to_add)
+		if views.add_view(view_to_add): # Handle the case where we added the view
 			# start thread to propagate changes across nodes without impacting service
 			new_thread = threading.Thread(target=views.send_new, args=(view_to_add,))
 			new_thread.start()
@@ -104,78 +188,625 @@ def put_view():
 # Synchronization Helper Functions #
 ####################################
 
+"""
+Record that an entry changed locally
+
+The key is moved to the end of the change log so the log stays ordered by
+version, which lets changed_since() walk it backwards and stop at the first
+entry the requester has already seen.
+"""
+def note_change(changes, key):
+	vars.version += 1
+	changes.pop(key, None)
+	changes[key] = vars.version
+
+"""
+Write a change to the log when there is one
+
+Must be called with change_lock held so the log has the same order as the
+changes. The returned sequence number goes to wait_logged() once the lock is
+released, so writers don't hold each other up while the log hits the disk.
+"""
+def log_change(record):
+	if vars.wal is None:
+		return None
+	return vars.wal.append(record)
+
+def wait_logged(seq):
+	if seq is not None:
+		vars.wal.wait(seq)
+
+def store_kv(key, entry):
+	entry = engine.Entry(*entry)
+	with vars.change_lock:
+		vars.tree.update(key, vars.kvs_dict.get(key), entry)
+		vars.kvs_dict[key] = entry
+		note_change(vars.kvs_changes, key)
+		vars.tombstones.pop(key, None)
+		if entry.value == 'NULL':
+			vars.tombstones[key] = time.monotonic() + vars.tombstone_ttl
+			vars.key_index.discard(key)
+		else:
+			vars.key_index.add(key)
+		seq = log_change({'k': key, 'e': entry})
+	wait_logged(seq)
+
+# Merge the writes of 'node' up to 'contiguous' and in 'extra' into the history, change_lock must be held
+def record_history(node, contiguous, extra):
+	if not vars.history.merge(node, contiguous, extra):
+		return None
+	note_change(vars.history_changes, node)
+	vars.history_cond.notify_all()
+	contiguous, extra = vars.history[node]
+	return log_change({'h': node, 'c': contiguous, 'x': extra})
+
+def store_history(node, contiguous, extra):
+	with vars.change_lock:
+		seq = record_history(node, contiguous, extra)
+	wait_logged(seq)
+
+"""
+Give a write received by this node the next dot of this node
+
+The write is placed after everything this node has seen, not only after what
+the client sent, so it replaces whatever entry the node holds for the key.
+Returns the metadata of the write.
+"""
+def new_dot(clock):
+	with vars.change_lock:
+		dot = vars.history.next_seq(views.curr_view)
+		seq = record_history(views.curr_view, dot, [])
+		new_clock = causal.merge(clock, vars.history.contiguous)
+	wait_logged(seq)
+	return causal.encode(new_clock)
+
+"""
+Wait for every write a clock depends on to show up in the history
+
+Writes are replicated in the background, so a client can come back with
+metadata from a write this node has not received yet. Rather than refusing the
+request right away, give the write 'dependency_wait' seconds to arrive.
+Returns whether they all did.
+"""
+def wait_for_clock(clock):
+	with vars.history_cond:
+		return vars.history_cond.wait_for(lambda: vars.history.covers(clock), vars.dependency_wait)
+
+# Forget a key this node is no longer responsible for
+def drop_kv(key):
+	with vars.key_locks.for_key(key), vars.change_lock:
+		seq = remove_kv(key)
+	wait_logged(seq)
+
+# Remove a key altogether, its lock and change_lock must be held
+def remove_kv(key):
+	entry = vars.kvs_dict.pop(key, None)
+	if entry is not None:
+		vars.tree.update(key, entry, None)
+	vars.kvs_changes.pop(key, None)
+	vars.tombstones.pop(key, None)
+	vars.key_index.discard(key)
+	return log_change({'d': key})
+
+"""
+Forget the deleted keys whose tombstone expired
+
+A tombstone is what keeps an older write of the key, still in flight or on a
+replica that missed the delete, from bringing the value back. Once every
+replica had 'tombstone_ttl' seconds to hear about the delete it is removed.
+The check is made again under the lock of the key, in case it was written since.
+"""
+def expire_tombstones():
+	now = time.monotonic()
+	with vars.change_lock:
+		expired = []
+		for key, expiry in vars.tombstones.items():
+			if expiry > now:
+				break
+			expired.append(key)
+	for key in expired:
+		with vars.key_locks.for_key(key), vars.change_lock:
+			expiry = vars.tombstones.get(key)
+			if expiry is None or expiry > now:
+				continue
+			seq = remove_kv(key)
+		wait_logged(seq)
+	return len(expired)
+
+def expire_tombstones_forever():
+	while True:
+		time.sleep(vars.tombstone_check)
+		try:
+			expire_tombstones()
+		except Exception as e:
+			print("Could not expire tombstones: {}".format(e), file=sys.stderr)
+
+"""
+Compact the log into a snapshot of the current state
+
+The segment is closed and the dictionaries copied while no change can be made,
+then the copy is written to disk without blocking anyone.
+"""
+def take_snapshot():
+	with vars.change_lock:
+		segment = vars.wal.rotate()
+		state = {'kvs': vars.kvs_dict.checkpoint(), 'history': vars.history.to_json()}
+	vars.kvs_dict.sync()
+	vars.wal.write_snapshot(segment, state)
+
+def snapshot_forever():
+	while True:
+		time.sleep(vars.snapshot_interval)
+		if vars.wal.needs_snapshot():
+			try:
+				take_snapshot()
+			except Exception as e:
+				print("Could not write a snapshot: {}".format(e), file=sys.stderr)
+
+"""
+Rebuild the state saved in 'data_dir' and log every change there from now on
+
+The snapshot is loaded first, then the changes logged after it are applied in
+order. This happens before the log is opened, so nothing is logged twice.
+"""
+def recover_state(data_dir):
+	# The engine may already hold entries of its own
+	vars.tree.rebuild(vars.kvs_dict)
+	def live_keys():
+		# When the tombstones were left isn't known, they are kept a full TTL from now
+		expiry = time.monotonic() + vars.tombstone_ttl
+		for key, entry in vars.kvs_dict.items():
+			if entry[0] == 'NULL':
+				vars.tombstones[key] = expiry
+			else:
+				yield key
+	vars.key_index.rebuild(live_keys())
+	snapshot, records = storage.recover(data_dir)
+	if snapshot is not None:
+		# Engines keeping their entries on disk don't put them in the snapshot
+		if snapshot['kvs'] is not None:
+			for key, entry in snapshot['kvs'].items():
+				store_kv(key, entry)
+		for node, (contiguous, extra) in snapshot['history'].items():
+			store_history(node, contiguous, extra)
+	for record in records:
+		if 'k' in record:
+			store_kv(record['k'], record['e'])
+		elif 'h' in record:
+			store_history(record['h'], record['c'], record['x'])
+		elif 'd' in record:
+			drop_kv(record['d'])
+	print("Recovered {} keys from {}".format(len(vars.kvs_dict), data_dir))
+	vars.wal = storage.WriteAheadLog(data_dir)
+
+"""
+Collect the entries of 'source' that changed after version 'since'
+
+Returns the current version along with the changed entries, so the caller can
+use it as its next watermark.
+"""
+def changed_since(source, changes, since):
+	delta = {}
+	with vars.change_lock:
+		for key in reversed(changes):
+			if changes[key] <= since:
+				break
+			delta[key] = source[key]
+		return vars.version, delta
+
+"""
+Report how many requests this node sent to each other node and how many
+connections it had to open for them
+"""
+@app.route('/node-client-metrics', methods=['GET'])
+def get_node_client_metrics():
+	json_response = jsonify(message="Metrics retrieved successfully", metrics=node_client.metrics(), reads=balancer.metrics(), replication=replication.metrics())
+	response = make_response(json_response, 200)
+	return response
+
+"""
+Report the memory this node uses, to size nodes
+
+The sizes of the KVS and of the structures kept per key are estimates, made
+from a sample of the entries. The size of the whole process is what the OS
+reports.
+"""
+@app.route('/memory-usage', methods=['GET'])
+def get_memory_usage():
+	usage = {}
+	usage['keys'] = len(vars.kvs_dict)
+	usage['tombstones'] = len(vars.tombstones)
+	usage['kvs-bytes'] = vars.kvs_dict.memory()
+	usage['change-log-bytes'] = sys.getsizeof(vars.kvs_changes) + sys.getsizeof(vars.history_changes)
+	usage['tombstone-bytes'] = sys.getsizeof(vars.tombstones)
+	usage['merkle-bytes'] = sum(sys.getsizeof(bucket) for bucket in vars.tree.buckets)
+	usage['history-nodes'] = len(vars.history)
+	usage['read-cache-keys'] = vars.read_cache.metrics()['size']
+	usage['process-bytes'] = process_memory()
+	json_response = jsonify(message="Memory usage retrieved successfully", usage=usage)
+	response = make_response(json_response, 200)
+	return response
+
+# Resident size of the process, or its peak where the current one isn't available
+def process_memory():
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except Exception as e:
+		import resource
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Report the writes kept for nodes that are down, see hints.py
+@app.route('/hint-metrics', methods=['GET'])
+def get_hint_metrics():
+	json_response = jsonify(message="Metrics retrieved successfully", metrics=hints.metrics())
+	response = make_response(json_response, 200)
+	return response
+
+# Report how often reads of keys owned by other shards were served from the cache
+@app.route('/read-cache-metrics', methods=['GET'])
+def get_read_cache_metrics():
+	json_response = jsonify(message="Metrics retrieved successfully", metrics=vars.read_cache.metrics())
+	response = make_response(json_response, 200)
+	return response
+
+"""
+Handle a state pull from another replica
+
+Without arguments the whole dictionary is returned. With ?since=<version> only
+the entries that changed after that version are returned, along with the
+current version of this node.
+
+A request accepting a stream (see node_client.stream()) gets the answer
+streamed instead, one [key, entry] at a time, after the version when there is
+one. The entries are read and written out one at a time, so a whole
+dictionary is never copied or encoded at once.
+"""
 @app.route('/new-replica-kvs', methods=['GET'])
 def new_replica_kvs():
-	payload = jsonify(vars.kvs_dict)
-	response = make_response(payload, 200)
-	return response
+	since = request.args.get('since')
+	if wants_stream():
+		if since is None:
+			return stream_lines(None, vars.kvs_dict.stream())
+		version, delta = changed_since(vars.kvs_dict, vars.kvs_changes, int(since))
+		return stream_lines(version, delta.items())
+	if since is None:
+		with vars.change_lock:
+			kvs = dict(vars.kvs_dict.items())
+		return internal_response(kvs)
+	version, delta = changed_since(vars.kvs_dict, vars.kvs_changes, int(since))
+	return internal_response({'version': version, 'kvs': delta})
 
 @app.route('/new-replica-history', methods=['GET'])
 def new_replica_history():
-	payload = jsonify(vars.history_dict)
-	response = make_response(payload, 200)
+	since = request.args.get('since')
+	if since is None:
+		with vars.change_lock:
+			history = vars.history.to_json()
+		if wants_stream():
+			return stream_lines(None, history.items())
+		return internal_response(history)
+	version, delta = changed_since(vars.history, vars.history_changes, int(since))
+	if wants_stream():
+		return stream_lines(version, delta.items())
+	return internal_response({'version': version, 'history': delta})
+
+def wants_stream():
+	accepted = codec.listed(request.headers.get('Accept'))
+	return codec.NDJSON in accepted or codec.MSGPACK_STREAM in accepted
+
+"""
+Stream 'items', after {"version": version} unless it is None
+
+NDJSON, or MessagePack values one after the other if the request takes them,
+compressed with the best compression the request accepts. Values are sent in
+chunks of about 'stream_chunk' bytes rather than one by one.
+"""
+def stream_lines(version, items):
+	binary = codec.takes_binary(request.headers.get('Accept'), codec.MSGPACK_STREAM)
+	encoding = codec.pick_encoding(request.headers.get('Accept-Encoding'))
+	def generate():
+		compressor = None if encoding is None else codec.StreamCompressor(encoding)
+		lines = []
+		size = 0
+		if version is not None:
+			lines.append(codec.stream_item({'version': version}, binary))
+		for item in items:
+			line = codec.stream_item(item, binary)
+			lines.append(line)
+			size += len(line)
+			if size >= vars.stream_chunk:
+				chunk = b''.join(lines)
+				yield chunk if compressor is None else compressor.compress(chunk)
+				lines = []
+				size = 0
+		chunk = b''.join(lines)
+		yield chunk if compressor is None else compressor.compress(chunk) + compressor.flush()
+	response = Response(generate(), status=200, mimetype=codec.MSGPACK_STREAM if binary else codec.NDJSON)
+	if encoding is not None:
+		response.headers['Content-Encoding'] = encoding
+	response.headers['Accept-Encoding'] = ', '.join(codec.encodings)
+	return response
+
+"""
+Read the body of a request from another node or a client
+
+JSON as always, unless another node sent it in MessagePack or compressed (see
+node_client.encode()).
+"""
+def read_body():
+	content_type = request.headers.get('Content-Type', '')
+	encoding = request.headers.get('Content-Encoding')
+	if encoding is None and not content_type.startswith(codec.MSGPACK):
+		return request.get_json()
+	return codec.unwrap(request.get_data(), content_type, encoding)
+
+"""
+Answer a request from another node, in MessagePack if it takes it
+
+The answer also lists the compressions this node decodes, which is how the
+other node learns what to send (see node_client.learn()).
+"""
+def internal_response(payload, status=200):
+	binary = codec.takes_binary(request.headers.get('Accept'))
+	response = make_response(codec.dumps(payload, binary), status)
+	response.headers['Content-Type'] = codec.MSGPACK if binary else codec.JSON
+	response.headers['Accept-Encoding'] = ', '.join(codec.encodings)
 	return response
 
-def update_dicts():
+# A body this node can't decode, sent by a node with modules it doesn't have
+@app.errorhandler(codec.Unsupported)
+def unsupported_body(error):
+	return internal_response({'message': "Unsupported encoding", 'error': str(error)}, 415)
+
+"""
+Pull the entries a replica streams and merge them as they arrive
+
+Merged 'stream_batch' at a time, so only that many are ever held. Returns the
+version the replica sent first, None if it sent none.
+"""
+def merge_kvs_stream(other_view, **kwargs):
+	version = None
+	batch = dict()
+	for item in node_client.stream(other_view, '/new-replica-kvs', **kwargs):
+		if isinstance(item, dict):
+			version = item['version']
+			continue
+		batch[item[0]] = item[1]
+		if len(batch) >= vars.stream_batch:
+			merge_kvs(batch)
+			batch = dict()
+	merge_kvs(batch)
+	return version
+
+# Fetch the history a replica streams, returns its version (None if it sent none) and the history
+def fetch_history_stream(other_view, **kwargs):
+	version = None
+	history = dict()
+	for item in node_client.stream(other_view, '/new-replica-history', **kwargs):
+		if isinstance(item, dict):
+			version = item['version']
+		else:
+			history[item[0]] = item[1]
+	return version, history
+
+def is_newer(entry, current):
+	return current is None or causal.is_newer(entry[1], current[1])
+
+"""
+Store an entry unless the one we have is newer
+
+The comparison and the write happen under the lock of the key, so two writes
+racing on the same key can't leave the older one in place. Returns whether
+the entry was stored.
+
+A tombstone synced from another replica ('synced') is only stored over an
+entry of the key. Without one there is nothing to delete, and the tombstone
+may be one this node already expired: storing it again would have the replicas
+hand it back and forth forever.
+"""
+def store_if_newer(key, entry, synced=False):
+	with vars.key_locks.for_key(key):
+		current = vars.kvs_dict.get(key)
+		if synced and current is None and entry[0] == 'NULL':
+			return False
+		if not is_newer(entry, current):
+			return False
+		store_kv(key, entry)
+		return True
+
+# Merge the history of another replica into ours
+def merge_history(history):
+	for node, (contiguous, extra) in history.items():
+		store_history(node, contiguous, extra)
+
+# Keep the entries that belong to our shard and are newer than what we have
+def merge_kvs(entries):
+	for key, entry in entries.items():
+		if find_shard(key) != views.curr_shard:
+			continue
+		store_if_newer(key, entry, synced=True)
+
+"""
+Handle a Merkle tree exchange from another replica
+
+Returns the hashes of the requested nodes (?nodes=1,2,3) on the requested level
+(?level=<n>, 0 is the root) of our tree, along with our current version.
+"""
+@app.route('/replica-merkle-tree', methods=['GET'])
+def replica_merkle_tree():
+	level = int(request.args.get('level', 0))
+	nodes = [int(n) for n in request.args.get('nodes', '0').split(',') if n != '']
+	return internal_response({'version': vars.version, 'depth': vars.tree.depth, 'hashes': vars.tree.hashes(level, nodes)})
+
+"""
+Handle a request for the entries of some leaf buckets (?buckets=1,2,3)
+"""
+@app.route('/replica-merkle-buckets', methods=['GET'])
+def replica_merkle_buckets():
+	buckets = [int(b) for b in request.args.get('buckets', '').split(',') if b != '']
+	with vars.change_lock:
+		entries = {k: vars.kvs_dict[k] for k in vars.tree.keys_in(buckets)}
+	return internal_response({'kvs': entries})
+
+"""
+Bring our KVS up to date with another replica by comparing Merkle trees
+
+Walks both trees from the root down, only following the nodes whose hashes
+differ, then pulls the entries of the leaf buckets that differ. Returns the
+version the other replica was at when we started, everything it changes after
+that is picked up by pull_deltas().
+"""
+def reconcile(other_view):
+	resp = node_client.load(node_client.get(other_view, '/replica-merkle-tree', params={'level': 0, 'nodes': '0'}))
+	version = resp['version']
+	if resp['depth'] != vars.tree.depth:
+		merge_kvs_stream(other_view)
+		return version
+
+	diverging = [0]
+	if resp['hashes'] == vars.tree.hashes(0, diverging):
+		return version
+	for level in range(1, vars.tree.depth + 1):
+		nodes = []
+		for node in diverging:
+			nodes.extend([2 * node, 2 * node + 1])
+		resp = node_client.load(node_client.get(other_view, '/replica-merkle-tree', params={'level': level, 'nodes': ','.join(map(str, nodes))}))
+		local = vars.tree.hashes(level, nodes)
+		diverging = [node for node, theirs, ours in zip(nodes, resp['hashes'], local) if theirs != ours]
+		if len(diverging) == 0:
+			return version
+
+	resp = node_client.load(node_client.get(other_view, '/replica-merkle-buckets', params={'buckets': ','.join(map(str, diverging))}))
+	merge_kvs(resp['kvs'])
+	return version
+
+"""
+Pull and merge everything a replica changed since our last pull from it
+
+The history is merged node by node, KVS entries replace the local ones when
+they carry newer metadata.
+"""
+def pull_deltas(other_view):
+	since = vars.watermarks.get(other_view, 0)
+	if since == 0:
+		# First contact, only fetch the keys that differ and go on from there
+		# The history is fetched first and merged last, so it never claims a write we don't have yet
+		hist_version, history = fetch_history_stream(other_view, params={'since': 0})
+		since = reconcile(other_view)
+		merge_history(history)
+		vars.watermarks[other_view] = since
+		return
+
+	hist_version, history = fetch_history_stream(other_view, params={'since': since})
+	if hist_version < since:
+		# The other replica restarted, start over from the beginning
+		vars.watermarks[other_view] = 0
+		return
+	# A restart shows in the version, which comes before any entry is merged
+	kvs_version = merge_kvs_stream(other_view, params={'since': since})
+	if kvs_version < since:
+		vars.watermarks[other_view] = 0
+		return
+
+	merge_history(history)
+	vars.watermarks[other_view] = min(kvs_version, hist_version)
+
+def update_dicts(full=False):
 	#for other_view in views.known_views:
-	for other_view in views.shard_count[views.curr_shard]:
+	for other_view in views.shard_count.get(views.curr_shard, []):
 		if other_view == views.curr_view:
 			continue
 		try:
-			resp1 = requests.get('http://' + other_view + '/new-replica-kvs', timeout=3)
-			resp3 = requests.get('http://' + other_view + '/new-replica-history', timeout=3)
-			
-			new_kvs = resp1.json()
-			new_hist = resp3.json()
-			if (len(new_kvs) > len(vars.kvs_dict)) or (len(new_hist) > len(vars.history_dict)):
-				vars.kvs_dict = new_kvs
-				vars.history_dict = new_hist
-				break
+			if full:
+				reconcile(other_view)
+			pull_deltas(other_view)
 		except Exception as e:
 			pass
 
+"""
+Keep this replica in sync with the rest of its shard
+
+Runs an infinite loop pulling deltas from the other replicas of the shard.
+Every 'merkle_rounds' rounds the Merkle trees are compared as well, to repair
+anything the deltas missed.
+This should be run in a separate thread so reads never wait on other replicas.
+"""
+def sync_dicts():
+	rounds = 0
+	while True:
+		rounds += 1
+		update_dicts(full=(rounds % vars.merkle_rounds == 0))
+		time.sleep(vars.sync_interval)
+
 
 ##################
 # KVS Operations #
 ##################
 
 def find_shard(key):
-	k = str(key)
-	c = 0
-	for char in k:
-		c += ord(char)
-	return (c % len(views.shard_count)) + 1
+	return partitioner.for_shards(views.shard_count.keys()).find(key)
 
-def common_put(meta, value, key):
-	shard_to_put = find_shard(key) # Find the shard
+"""
+Place a write in the causal history
 
-	if meta == '':
-		# If meta wasn't provided, find the old one and generate new
-		if len(vars.history_dict) == 0:
-			meta = 'V0' 
-			new_meta = 'V1'
-		else:
-			meta = 'V'  + str(len(vars.history_dict) +1)
-			new_meta = 'V' + str(len(vars.history_dict) + 2)
-	else:
-		# Find the latest metadata and generate the new one
-		meta = meta.strip('<')
-		meta = meta.strip('>')
-
-		while meta in vars.history_dict:
-			meta = vars.history_dict[meta]
-		# Verify that the found metadata is ok:
-		if meta in vars.history_dict.values():
-			new_meta = "V" + str(len(vars.history_dict)+1)
-		else:
-			if shard_to_put == views.curr_shard:
-				json_response = jsonify( message="Metadata is not in local dictionary", views=views.known_views)
-				response = make_response(json_response, 400)
-				return response
-			return None
+'meta' is the causal metadata the client sent, the writes this one depends on.
+'new_meta' is the metadata the node the write originated on, 'origin', gave
+it, None when the write originates here and needs a new dot. When the dot is
+already part of our history, the write reached us through synchronization
+before the replication message did.
+
+Older nodes don't send 'origin'. Their metadata is the client's clock plus the
+dot, so the dot is the one count that grew. When it can't be told, the write is
+applied as a new one without recording its dot, synchronization brings the
+history in later.
+
+Returns the metadata of the write (None when the writes it depends on never
+arrived) and whether it was already applied here.
+"""
+def order_write(meta, new_meta, origin):
+	clock = causal.decode(meta)
+	if new_meta is not None:
+		new_clock = causal.decode(new_meta)
+		if origin is None:
+			grown = [node for node, count in new_clock.items() if count > clock.get(node, 0)]
+			origin = grown[0] if len(grown) == 1 else None
+		seq = new_clock.get(origin, 0)
+		if origin is not None and vars.history.has(origin, seq):
+			return new_meta, True
+	if not wait_for_clock(clock):
+		return None, False
+	if new_meta is None:
+		return new_dot(clock), False
+	if origin is not None:
+		store_history(origin, 0, [seq])
+	return new_meta, False
+
+"""
+Apply a PUT to this node
+
+'new_meta' is the metadata the originating node generated for this write, see
+order_write(), as is 'origin'.
 
-	# Update history
-	vars.history_dict[meta] = new_meta
+Returns the response for the client (None when another shard owns the key or
+the write was already applied) along with the metadata of the write.
+"""
+def common_put(meta, value, key, new_meta=None, origin=None):
+	shard_to_put = find_shard(key) # Find the shard
+
+	new_meta, applied = order_write(meta, new_meta, origin)
+	if shard_to_put != views.curr_shard and new_meta is not None:
+		vars.read_cache.invalidate(key, new_meta)
+	if applied:
+		if shard_to_put == views.curr_shard:
+			store_if_newer(key, [value, new_meta])
+		return None, new_meta
+	elif new_meta is None:
+		if shard_to_put == views.curr_shard:
+			json_response = jsonify( message="Metadata is not in local dictionary", views=views.known_views)
+			response = make_response(json_response, 400)
+			return response, None
+		return None, None
 
 	# Check if the shard is correct
 	if shard_to_put == views.curr_shard:
@@ -192,48 +823,127 @@ def common_put(meta, value, key):
 			payload['shard-id'] = shard_to_put
 			json_response = jsonify(payload)
 			response = make_response(json_response, 201)
-		vars.kvs_dict[key] = [value, new_meta]
-		return response
+		store_if_newer(key, [value, new_meta])
+		return response, new_meta
 	else:
+		return None, new_meta
+
+
+"""
+Consistency levels a client can ask for with ?consistency=<level>
+
+The number of replicas of the shard that must take part in the request: one,
+a majority or all of them. Writes default to the write quorum, reads to ONE.
+"""
+LEVELS = ('ONE', 'QUORUM', 'ALL')
+
+# The consistency level asked for, None if none was, '' if it isn't one we know
+def requested_level():
+	level = request.args.get('consistency')
+	if level is None:
 		return None
+	level = level.upper()
+	return level if level in LEVELS else ''
+
+def replicas_needed(level, members):
+	if level == 'ONE':
+		return 1
+	if level == 'QUORUM':
+		return len(members) // 2 + 1
+	if level == 'ALL':
+		return len(members)
+	return None
+
+# The query string passing the consistency level on to another node
+def level_query(level):
+	return '' if level is None else '?consistency=' + level
 
+def unknown_level(method):
+	json_response = jsonify(message="Unknown consistency level, use one of " + ', '.join(LEVELS), error="Error in " + method)
+	return make_response(json_response, 400)
+
+"""
+Send a PUT or DELETE on to the other nodes
+
+The write was already applied here and 'return_val' is the response for the
+client, which is returned once enough of the shard acknowledged the write: as
+many as the consistency level 'level' asks for, the write quorum by default.
+"""
+def propagate_write(method, key, payload, return_val, level=None):
+	if return_val.status_code >= 300:
+		# The write was refused here, there is nothing to replicate
+		return return_val
+
+	shard = find_shard(key)
+	needed = replicas_needed(level, views.shard_count.get(shard, []))
+	acked, statuses = replication.replicate([dict(payload, key=key)], shard, needed)
+	if not acked:
+		# The write is applied here and may still reach the other replicas, so the client gets its metadata
+		payload = {'message': "Write quorum not reached", 'error': "Error in " + method}
+		payload['causal-metadata'] = return_val.get_json().get('causal-metadata', '')
+		json_response = jsonify(payload)
+		response = make_response(json_response, 503)
+		return response
+	return return_val
+
+# The members of a shard, the ones last seen alive first
+def members_by_health(shard):
+	members = views.shard_count.get(shard, [])
+	alive = views.alive_views
+	return [m for m in members if m in alive] + [m for m in members if m not in alive]
+
+# Tell clients which shard owns the key, so they can go straight there next time
+def with_shard(response, shard):
+	response.headers['X-Shard-Id'] = str(shard)
+	return response
+
+"""
+Send a client request for a key owned by another shard to that shard
+
+A single request goes to one member of the shard, the next member is only tried
+when a member can't be connected to. The answer of the member is returned as is.
+"""
+def forward_to_shard(method, key, payload, shard, level=None):
+	for member in members_by_health(shard):
+		if member == views.curr_view:
+			continue
+		try:
+			response = node_client.request(method, member, '/key-value-store/' + key + level_query(level), payload, timeout=vars.forward_timeout)
+		except node_client.ConnectionFailed:
+			continue
+		except Exception as e:
+			break
+		answer = response.json()
+		if answer.get('causal-metadata'):
+			vars.read_cache.invalidate(key, answer['causal-metadata'])
+		return with_shard(make_response(jsonify(answer), response.status_code), shard)
+	json_response = jsonify(message="Shard unavailable", error="Error in " + method)
+	return with_shard(make_response(json_response, 503), shard)
 
 @app.route('/key-value-store/<string:key>', methods=['PUT'])
 def put_kv(key):
 	#update_dicts()
-	json_value = request.get_json()
+	json_value = read_body()
+	level = requested_level()
+	if level == '':
+		return unknown_level('PUT')
+	shard = find_shard(key)
+	if shard != views.curr_shard:
+		return forward_to_shard('PUT', key, json_value, shard, level)
 	meta = json_value['causal-metadata']
 	value = str(json_value['value'])
 
-	return_val = common_put(meta, value, key)
-	if return_val is None:
-		# This is not the correct shard, it should be forwarded
-		best_json = None
-		best_status = 404
-		for view in views.known_views[:]:
-			if view != views.curr_view:
-				payload = {'value': value, 'causal-metadata': meta}
-				response = requests.put( 'http://' + view + '/selfish-key-value-store/' + key, headers=views.HEADERS, data=json.dumps(payload))
-				if response.status_code < best_status and response.status_code != 202:
-					best_status = response.status_code
-					best_json = response.json()
-		json_response = jsonify(best_json)
-		response = make_response(json_response, best_status)
-		return response
-	else:
-		for view in views.known_views[:]:
-			if view != views.curr_view:
-				payload = {'value': value, 'causal-metadata': meta}
-				response = requests.put( 'http://' + view + '/selfish-key-value-store/' + key, headers=views.HEADERS, data=json.dumps(payload))
-		return return_val
+	return_val, new_meta = common_put(meta, value, key)
+	payload = {'value': value, 'causal-metadata': meta, 'new-causal-metadata': new_meta, 'origin': views.curr_view}
+	return with_shard(propagate_write('PUT', key, payload, return_val, level), shard)
 
 # Same as put, but don't propagate to other nodes to prevent cycles
 @app.route('/selfish-key-value-store/<string:key>', methods=['PUT'])
 def selfish_put_kv(key):
-	json_value = request.get_json()
+	json_value = read_body()
 	meta = json_value['causal-metadata']
 	value = str(json_value['value'])
-	return_val = common_put(meta, value, key)
+	return_val, new_meta = common_put(meta, value, key, json_value.get('new-causal-metadata'), json_value.get('origin'))
 	if return_val is None:
 		payload = {'Message': 'History updated'}
 		json_response = jsonify(payload)
@@ -245,19 +955,151 @@ def selfish_put_kv(key):
 
 @app.route('/key-value-store/<string:key>', methods=['GET'])
 def get_kv(key):
-	update_dicts()
+	level = requested_level()
+	if level == '':
+		return unknown_level('GET')
 	correct_shard = find_shard(key)
 	if correct_shard != views.curr_shard:
 		# Handle the case where we should forward
-		response = requests.get('http://' + views.shard_count[correct_shard][0] + '/key-value-store/' + key, timeout=5)
-		json_response = jsonify(response.json())
-		response = make_response(json_response, response.status_code)
+		return forward_read(key, correct_shard, level)
+
+	if level in ('QUORUM', 'ALL'):
+		return with_shard(quorum_read(key, correct_shard, level), correct_shard)
+
+	if key not in vars.kvs_dict and len(views.prev_shard_count) > 0:
+		# A reshard is going on and the key may not have been migrated here yet
+		response = read_previous_owner(key)
+		if response is not None:
+			return with_shard(response, correct_shard)
+	return with_shard(read_local(key), correct_shard)
+
+"""
+Read a key from the shard owning it
+
+Values already read are served from the cache (see cache.py). Otherwise the
+read goes to the member of the shard the balancer picks from the ones alive,
+so reads are spread over the replicas by how busy and how fast they are. If
+the member fails, the next one is tried. Reads at a consistency level above
+ONE skip the cache, the member reads from the other replicas itself.
+"""
+def forward_read(key, shard, level=None):
+	if level in ('QUORUM', 'ALL'):
+		return fetch_from_shard(key, shard, level)
+	cached = vars.read_cache.lookup(key)
+	if cached is not None:
+		payload = {'message': "Retrieved successfully", 'causal-metadata': cached[1], 'value': cached[0]}
+		return with_shard(make_response(jsonify(payload), 200), shard)
+
+	value, metadata = None, None
+	try:
+		response = fetch_from_shard(key, shard)
+		if response.status_code == 200:
+			answer = response.get_json()
+			value, metadata = answer['value'], answer['causal-metadata']
 		return response
-		
+	finally:
+		vars.read_cache.fill(key, value, metadata)
+
+def fetch_from_shard(key, shard, level=None):
+	members = [m for m in views.shard_count.get(shard, []) if m != views.curr_view]
+	for member in balancer.order(members, views.alive_views):
+		try:
+			with balancer.track(member):
+				response = node_client.get(member, '/key-value-store/' + key + level_query(level))
+		except Exception as e:
+			continue
+		return with_shard(make_response(jsonify(response.json()), response.status_code), shard)
+	json_response = jsonify(message="Shard unavailable", error="Error in GET")
+	return with_shard(make_response(json_response, 503), shard)
+
+"""
+Read a key from as many replicas of its shard as the consistency level asks for
+
+The other members last seen alive are asked for their entry all at the same
+time, and the newest entry of the first answers (this node's included) is
+returned once there are enough of them. The members that answered with an
+older entry, or none, are sent the newest one in the background (read
+repair), and so is this node.
+"""
+def quorum_read(key, shard, level):
+	members = views.shard_count.get(shard, [])
+	needed = replicas_needed(level, members)
+	entries = {views.curr_view: vars.kvs_dict.get(key)}
+	futures = [aio.submit(fetch_entry(member, key)) for member in members if member != views.curr_view and member in views.alive_views]
+	if len(entries) < needed:
+		for future in concurrent.futures.as_completed(futures):
+			member, found, entry = future.result()
+			if found:
+				entries[member] = entry
+				if len(entries) >= needed:
+					break
+	if len(entries) < needed:
+		json_response = jsonify(message="Read quorum not reached", error="Error in GET")
+		return make_response(json_response, 503)
+
+	newest = None
+	for entry in entries.values():
+		if entry is not None and is_newer(entry, newest):
+			newest = entry
+	if newest is not None:
+		for member, entry in entries.items():
+			if entry is None or is_newer(newest, entry):
+				repair(member, key, newest)
+	return entry_response(newest)
+
+# Returns the member, whether it answered and its entry for the key
+async def fetch_entry(member, key):
+	try:
+		response = await aio.request('GET', member, '/selfish-key-value-store/' + key + '?entry=true')
+		return member, True, node_client.load(response)['entry']
+	except Exception as e:
+		return member, False, None
+
+# Send the newest entry of a key to a replica that has an older one
+def repair(member, key, entry):
+	if member == views.curr_view:
+		store_if_newer(key, entry, synced=True)
+	else:
+		aio.submit(aio.request('PUT', member, '/key-value-store-shard/migrate-in', {'kvs': {key: entry}}))
+
+"""
+Read a key from the shard that owned it before the reshard in progress
+
+Returns None if none of the previous owners could be reached.
+"""
+def read_previous_owner(key):
+	prev_shard = partitioner.build(views.prev_shard_count.keys()).find(key)
+	for member in views.prev_shard_count.get(prev_shard, []):
+		if member == views.curr_view:
+			continue
+		try:
+			response = node_client.get(member, '/selfish-key-value-store/' + key)
+		except Exception as e:
+			continue
+		return make_response(jsonify(response.json()), response.status_code)
+	return None
+
+"""
+Same as get, but only looks at this node, whichever shard owns the key
+
+With ?entry=true the entry itself is returned, tombstones included, for
+another replica to compare with its own.
+"""
+@app.route('/selfish-key-value-store/<string:key>', methods=['GET'])
+def selfish_get_kv(key):
+	if request.args.get('entry') == 'true':
+		return internal_response({'entry': vars.kvs_dict.get(key)})
+	return read_local(key)
+
+def read_local(key):
+	return entry_response(vars.kvs_dict.get(key))
+
+# The answer to a GET for a key whose entry is 'entry', None if there is none
+def entry_response(entry):
 	value = ''
-	if key in vars.kvs_dict and vars.kvs_dict[key][0] != 'NULL':
-		value = vars.kvs_dict[key][0]
-		metadata = "<" + str(vars.kvs_dict[key][1]) + ">"
+	if entry is not None and entry[0] != 'NULL':
+		value = entry[0]
+		metadata = "<" + str(entry[1]) + ">"
 		
 		payload = {}
 		payload['message'] = "Retrieved successfully"
@@ -272,31 +1114,26 @@ def get_kv(key):
 		response = make_response(json_response, 404)
 		return response
 
-def common_delete(meta, key):
+def common_delete(meta, key, new_meta=None, origin=None):
 	shard_to_put = find_shard(key) # Find the shard
 	if meta == "": # Metadata not given
 		json_response = jsonify( message="Metadata not provided!")
 		response = make_response(json_response, 400)
-		return response
-	else:
-		meta = meta.strip('<')
-		meta = meta.strip('>')
-		#checks to see if metadata is in casual history of this thread
-		
-		while meta in vars.history_dict:
-			meta = vars.history_dict[meta]
-		# Verify that the found metadata is ok:
-		if meta in vars.history_dict.values():
-			new_meta = "V" + str(len(vars.history_dict)+1)
-		else:
-			if shard_to_put == views.curr_shard:
-				json_response = jsonify( message="Metadata is not in local dictionary", views=views.known_views)
-				response = make_response(json_response, 400)
-				return response
-			return None
-	
-	# Update history
-	vars.history_dict[meta] = new_meta
+		return response, None
+
+	new_meta, applied = order_write(meta, new_meta, origin)
+	if shard_to_put != views.curr_shard and new_meta is not None:
+		vars.read_cache.invalidate(key, new_meta)
+	if applied:
+		if shard_to_put == views.curr_shard:
+			store_if_newer(key, ['NULL', new_meta])
+		return None, new_meta
+	elif new_meta is None:
+		if shard_to_put == views.curr_shard:
+			json_response = jsonify( message="Metadata is not in local dictionary", views=views.known_views)
+			response = make_response(json_response, 400)
+			return response, None
+		return None, None
 
 	# Check if the shard is correct
 	if shard_to_put == views.curr_shard:
@@ -313,44 +1150,32 @@ def common_delete(meta, key):
 			payload['shard-id'] = shard_to_put
 			json_response = jsonify(payload)
 			response = make_response(json_response, 201)
-		vars.kvs_dict[key] = ['NULL', None]
-		return response
+		store_if_newer(key, ['NULL', new_meta])
+		return response, new_meta
 	else:
-		return None
+		return None, new_meta
 
 @app.route('/key-value-store/<string:key>', methods=['DELETE'])
 def delete_kv(key):
-	json_value = request.get_json()
+	json_value = read_body()
+	level = requested_level()
+	if level == '':
+		return unknown_level('DELETE')
+	shard = find_shard(key)
+	if shard != views.curr_shard:
+		return forward_to_shard('DELETE', key, json_value, shard, level)
 	meta = json_value['causal-metadata']
 
-	return_val = common_put(meta, key)
-	if return_val is None:
-		# This is not the correct shard, it should be forwarded
-		best_json = None
-		best_status = 404
-		for view in views.known_views[:]:
-			if view != views.curr_view:
-				payload = {'causal-metadata': meta}
-				response = requests.delete( 'http://' + view + '/selfish-key-value-store/' + key, headers=views.HEADERS, data=json.dumps(payload))
-				if response.status_code < best_status and response.status_code != 202:
-					best_status = response.status_code
-					best_json = response.json()
-		json_response = jsonify(best_json)
-		response = make_response(json_response, best_status)
-		return response
-	else:
-		for view in views.known_views[:]:
-			if view != views.curr_view:
-				payload = {'causal-metadata': meta}
-				response = requests.delete( 'http://' + view + '/selfish-key-value-store/' + key, headers=views.HEADERS, data=json.dumps(payload))
-		return return_val
+	return_val, new_meta = common_delete(meta, key)
+	payload = {'causal-metadata': meta, 'new-causal-metadata': new_meta, 'origin': views.curr_view}
+	return with_shard(propagate_write('DELETE', key, payload, return_val, level), shard)
 
 
 @app.route('/selfish-key-value-store/<string:key>', methods=['DELETE'])
 def seflish_delete_kv(key):
-	json_value = request.get_json()
+	json_value = read_body()
 	meta = json_value['causal-metadata']
-	return_val = common_put(meta, key)
+	return_val, new_meta = common_delete(meta, key, json_value.get('new-causal-metadata'), json_value.get('origin'))
 	if return_val is None:
 		payload = {'Message': 'Entry deleted updated'}
 		json_response = jsonify(payload)
@@ -360,6 +1185,389 @@ def seflish_delete_kv(key):
 		return return_val
 
 
+####################
+# Batch Operations #
+####################
+
+# Causal metadata covering all of several, without the brackets
+def latest_meta(metas):
+	return causal.encode(causal.merge(*[causal.decode(meta) for meta in metas]))
+
+def group_by_shard(items, key_of):
+	groups = dict()
+	for item in items:
+		groups.setdefault(find_shard(key_of(item)), []).append(item)
+	return groups
+
+"""
+Send a sub-batch to the shard owning its keys
+
+Tries the members of the shard, the ones last seen alive first, until one of
+them can be connected to. A member that took the batch but didn't answer in
+time may have applied it, so it isn't sent again. Returns the JSON of the
+answer, or None if no member answered.
+"""
+async def forward_batch(method, shard, payload):
+	for member in members_by_health(shard):
+		if member == views.curr_view:
+			continue
+		try:
+			response = await aio.request(method, member, '/key-value-store-batch', payload, timeout=vars.forward_timeout)
+			return response.json()
+		except aio.ConnectionFailed:
+			continue
+		except Exception as e:
+			break
+	return None
+
+"""
+Apply batch writes owned by this shard, in order
+
+Each write depends on the one before it, so the causal metadata is chained
+through the batch. An op with a 'value' is a PUT, one without is a DELETE.
+The writes the batch depends on are waited for once, and if they never arrive
+every key is refused with 400. Returns the result of every key, the ops that
+were applied (in the form the other replicas need them) and the metadata of
+the last write.
+"""
+def apply_batch(meta, ops):
+	results = dict()
+	applied = []
+	if not wait_for_clock(causal.decode(meta)):
+		for op in ops:
+			results[op['key']] = {'status': 400, 'shard-id': views.curr_shard}
+		return results, applied, meta
+	for op in ops:
+		key = op['key']
+		if 'value' in op:
+			return_val, new_meta = common_put(meta, op['value'], key)
+		else:
+			return_val, new_meta = common_delete(meta, key)
+		status = 503 if return_val is None else return_val.status_code
+		results[key] = {'status': status, 'shard-id': views.curr_shard}
+		if status < 300:
+			replica_op = {'key': key, 'causal-metadata': meta, 'new-causal-metadata': new_meta, 'origin': views.curr_view}
+			if 'value' in op:
+				replica_op['value'] = op['value']
+			applied.append(replica_op)
+			meta = new_meta
+	return results, applied, meta
+
+"""
+Handle a batch PUT or DELETE
+
+Bind to /key-value-store-batch. A PUT carries {"entries": {key: value, ...}},
+a DELETE carries {"keys": [key, ...]}, both with one causal metadata for the
+whole batch. The keys are grouped by shard: the ones owned here are applied and
+replicated to the shard in a single message, the others are forwarded as one
+sub-batch per shard, all at the same time. Returns the result of every key and
+the causal metadata of the latest write, with 207 if some keys failed.
+"""
+@app.route('/key-value-store-batch', methods=['PUT', 'DELETE'])
+def write_batch():
+	json_value = read_body()
+	meta = json_value.get('causal-metadata', '')
+	if request.method == 'PUT':
+		ops = [{'key': k, 'value': str(v)} for k, v in json_value['entries'].items()]
+	else:
+		ops = [{'key': k} for k in json_value['keys']]
+	groups = group_by_shard(ops, lambda op: op['key'])
+
+	# Send the sub-batches of other shards first so they run while we work
+	futures = dict()
+	for shard, shard_ops in groups.items():
+		if shard == views.curr_shard:
+			continue
+		if request.method == 'PUT':
+			payload = {'entries': {op['key']: op['value'] for op in shard_ops}, 'causal-metadata': meta}
+		else:
+			payload = {'keys': [op['key'] for op in shard_ops], 'causal-metadata': meta}
+		futures[shard] = aio.submit(forward_batch(request.method, shard, payload))
+
+	results = dict()
+	metas = []
+	if views.curr_shard in groups:
+		local_results, applied, last_meta = apply_batch(meta, groups[views.curr_shard])
+		if len(applied) > 0:
+			acked, statuses = replication.replicate(applied, views.curr_shard)
+			if acked:
+				metas.append(last_meta)
+			else:
+				for op in applied:
+					local_results[op['key']]['status'] = 503
+		results.update(local_results)
+
+	for shard, future in futures.items():
+		answer = future.result()
+		if answer is None:
+			for op in groups[shard]:
+				results[op['key']] = {'status': 503, 'shard-id': shard}
+		else:
+			results.update(answer['results'])
+			metas.append(answer['causal-metadata'])
+			for key in answer['results']:
+				vars.read_cache.invalidate(key, answer['causal-metadata'])
+
+	new_meta = latest_meta(metas)
+	payload = {}
+	payload['message'] = "Batch applied"
+	payload['causal-metadata'] = '<' + new_meta + '>' if new_meta != '' else meta
+	payload['results'] = results
+	json_response = jsonify(payload)
+	failed = [r for r in results.values() if r['status'] >= 300]
+	response = make_response(json_response, 207 if len(failed) > 0 else 200)
+	return response
+
+"""
+Same as a batch write, but applied as is and not propagated to prevent cycles
+
+This is how replicated writes arrive, many at once (see replication.Outbox),
+compressed when the message is large (see read_body()). Returns the status of every write, in
+order, as the single key endpoints would have.
+"""
+@app.route('/selfish-key-value-store-batch', methods=['PUT'])
+def selfish_write_batch():
+	json_value = read_body()
+	results = []
+	for op in json_value['ops']:
+		if 'value' in op:
+			return_val, new_meta = common_put(op['causal-metadata'], op['value'], op['key'], op.get('new-causal-metadata'), op.get('origin'))
+		else:
+			return_val, new_meta = common_delete(op['causal-metadata'], op['key'], op.get('new-causal-metadata'), op.get('origin'))
+		results.append(202 if return_val is None else return_val.status_code)
+	return internal_response({'message': "Batch applied", 'results': results})
+
+"""
+Handle a batch GET
+
+Bind to /key-value-store-batch and listen for a GET carrying {"keys": [...]}.
+Keys owned by this shard are read locally, the others are fetched with one
+request per shard, all at the same time. Returns the values found, the keys
+that don't exist, the keys whose shard could not be reached and the causal
+metadata of the latest value returned.
+"""
+@app.route('/key-value-store-batch', methods=['GET'])
+def read_batch():
+	json_value = read_body()
+	groups = group_by_shard(json_value['keys'], lambda key: key)
+
+	futures = dict()
+	for shard, keys in groups.items():
+		if shard != views.curr_shard:
+			futures[shard] = aio.submit(forward_batch('GET', shard, {'keys': keys}))
+
+	values = dict()
+	missing = []
+	unavailable = []
+	metas = []
+	for key in groups.get(views.curr_shard, []):
+		entry = vars.kvs_dict.get(key)
+		if entry is not None and entry[0] != 'NULL':
+			values[key] = entry[0]
+			metas.append(entry[1])
+		else:
+			missing.append(key)
+	for shard, future in futures.items():
+		answer = future.result()
+		if answer is None:
+			unavailable.extend(groups[shard])
+		else:
+			values.update(answer['values'])
+			missing.extend(answer['missing'])
+			unavailable.extend(answer['unavailable'])
+			metas.append(answer['causal-metadata'])
+
+	new_meta = latest_meta(metas)
+	payload = {}
+	payload['message'] = "Retrieved successfully"
+	payload['causal-metadata'] = '<' + new_meta + '>' if new_meta != '' else ''
+	payload['values'] = values
+	payload['missing'] = missing
+	payload['unavailable'] = unavailable
+	json_response = jsonify(payload)
+	response = make_response(json_response, 200)
+	return response
+
+
+################
+# Scan methods #
+################
+
+"""
+Read the arguments of a scan: prefix, start, end, cursor and limit
+
+Returns them as keyword arguments of OrderedIndex.scan(), None if the limit
+isn't a positive number.
+"""
+def scan_args():
+	try:
+		limit = int(request.args.get('limit', 100))
+	except ValueError:
+		return None
+	if limit <= 0:
+		return None
+	return {'prefix': request.args.get('prefix', ''), 'start': request.args.get('start'),
+		'end': request.args.get('end'), 'after': request.args.get('cursor'),
+		'limit': min(limit, index.max_limit)}
+
+"""
+The [key, value, metadata] of the keys owned here that a scan goes through, in
+order, and whether there may be more
+
+The index holds every key of the node, including the ones of another shard
+not dropped yet after a reshard, so it is read until 'limit' keys owned here
+were found. 'owner' is the shard to look for instead of the one of this node.
+"""
+def scan_local(args, owner=None):
+	shard = views.curr_shard if owner is None else owner
+	page = dict(args)
+	entries = []
+	more = False
+	while True:
+		keys = vars.key_index.scan(**page)
+		for key in keys:
+			entry = vars.kvs_dict.get(key)
+			if entry is None or entry[0] == 'NULL' or find_shard(key) != shard:
+				# Written or moved since the index was read, or owned by another shard
+				continue
+			entries.append([key, entry[0], entry[1]])
+		if len(entries) >= args['limit']:
+			entries, more = entries[:args['limit']], True
+			break
+		if len(keys) < page['limit']:
+			break
+		page['after'] = keys[-1]
+	if owner is None and len(views.prev_shard_count) > 0:
+		return merge_previous_owners(args, entries, more)
+	return entries, more
+
+"""
+Add to a page of scan_local() the keys not migrated here yet
+
+While a reshard is going on, the keys this shard took over may only be on the
+shard that owned them before (see read_previous_owner()). Every previous shard
+this node wasn't part of is asked for the keys it holds that belong here. Keys
+this node has an entry for, tombstones included, are left to it. A page that
+may go on only covers the keys up to its last one, so the merged page stops at
+the first of those.
+"""
+def merge_previous_owners(args, entries, more):
+	futures = []
+	for prev_shard, members in views.prev_shard_count.items():
+		if views.curr_view not in members:
+			futures.append(aio.submit(scan_shard(prev_shard, args, views.prev_shard_count, views.curr_shard)))
+	pages = [entries]
+	bound = entries[-1][0] if more else None
+	for future in futures:
+		answer = future.result()
+		if answer is None:
+			continue
+		page, page_more = answer
+		if page_more and len(page) > 0 and (bound is None or page[-1][0] < bound):
+			bound = page[-1][0]
+		more = more or page_more
+		pages.append([entry for entry in page if entry[0] not in vars.kvs_dict])
+	merged = []
+	for entry in heapq.merge(*pages, key=lambda entry: entry[0]):
+		if (bound is not None and entry[0] > bound) or (len(merged) > 0 and merged[-1][0] == entry[0]):
+			continue
+		merged.append(entry)
+	return merged[:args['limit']], more or len(merged) > args['limit']
+
+"""
+Scan the keys of another shard, None if no member could be reached
+
+Returns the page and whether there may be more. 'layout' is where the members
+of the shard are looked up, and 'owner' the shard whose keys they are asked for
+instead of their own.
+"""
+async def scan_shard(shard, args, layout=None, owner=None):
+	params = {'prefix': args['prefix'], 'start': args['start'], 'end': args['end'], 'cursor': args['after'], 'limit': args['limit'], 'owner': owner}
+	query = urllib.parse.urlencode({name: value for name, value in params.items() if value is not None})
+	members = [m for m in (layout or views.shard_count).get(shard, []) if m != views.curr_view]
+	for member in balancer.order(members, views.alive_views):
+		try:
+			response = await aio.request('GET', member, '/selfish-key-value-store-scan?' + query)
+			answer = node_client.load(response)
+			# Nodes of older versions don't say
+			return answer['entries'], answer.get('more', len(answer['entries']) >= args['limit'])
+		except Exception as e:
+			pass
+	return None
+
+"""
+Handle a scan
+
+Bind to /key-value-store-scan, listen for a GET with any of ?prefix=, ?start=
+(included), ?end= (excluded), ?limit= (100 by default, 1000 at most) and
+?cursor=. Every shard is asked for its first 'limit' keys in range at the same
+time, and the answers are merged in key order as the response is streamed.
+Returns the keys and values in order, the causal metadata of the latest value
+returned, the shards that could not be reached and, when there may be more
+keys, the cursor to pass to get the next page.
+"""
+@app.route('/key-value-store-scan', methods=['GET'])
+def scan():
+	args = scan_args()
+	if args is None:
+		json_response = jsonify(message="The limit must be a positive number", error="Error in GET")
+		return make_response(json_response, 400)
+
+	futures = dict()
+	for shard in views.shard_count.keys():
+		if shard != views.curr_shard:
+			futures[shard] = aio.submit(scan_shard(shard, args))
+	pages = []
+	unavailable = []
+	if views.curr_shard in views.shard_count:
+		pages.append(scan_local(args))
+	for shard, future in futures.items():
+		page = future.result()
+		if page is None:
+			unavailable.append(shard)
+		else:
+			pages.append(page)
+	more = any(page_more for page, page_more in pages)
+	# A page that may go on only covers the keys up to its last one
+	bound = min((page[-1][0] for page, page_more in pages if page_more and len(page) > 0), default=None)
+	pages = [page for page, page_more in pages]
+
+	def generate():
+		metas = []
+		last = None
+		# Whether the page was cut with keys left over, which the next page starts from
+		cut = False
+		yield '{"entries": ['
+		for count, (key, value, meta) in enumerate(heapq.merge(*pages, key=lambda entry: entry[0])):
+			if count >= args['limit'] or (bound is not None and key > bound):
+				cut = True
+				break
+			yield (', ' if count > 0 else '') + json.dumps({'key': key, 'value': value})
+			metas.append(meta)
+			last = key
+		new_meta = latest_meta(metas)
+		yield '], "causal-metadata": ' + json.dumps('<' + new_meta + '>' if new_meta != '' else '')
+		yield ', "cursor": ' + json.dumps(last if more or cut else None)
+		yield ', "unavailable": ' + json.dumps(unavailable) + '}'
+	return Response(generate(), status=200, mimetype='application/json')
+
+"""
+Same as a scan, but only goes through the keys of this node
+
+With ?owner= the keys of that shard are returned instead of the ones of the
+shard of this node, for a node that took them over in a reshard.
+"""
+@app.route('/selfish-key-value-store-scan', methods=['GET'])
+def selfish_scan():
+	args = scan_args()
+	if args is None:
+		json_response = jsonify(message="The limit must be a positive number", error="Error in GET")
+		return make_response(json_response, 400)
+	owner = request.args.get('owner')
+	entries, more = scan_local(args, None if owner is None else int(owner))
+	return internal_response({'entries': entries, 'more': more})
+
+
 #################
 # SHARD methods #
 #################
@@ -409,6 +1617,10 @@ def get_nodeShardMembers(ID):
 	response = make_response(json_response, 200)
 	return response
 
+# Number of live keys this node holds for its shard, tombstones and keys moved away by a reshard aside
+def count_keys():
+	return sum(1 for key in vars.key_index.keys() if find_shard(key) == views.curr_shard)
+
 @app.route('/key-value-store-shard/shard-id-key-count/<string:ID>', methods=['GET'])
 def get_numKeys(ID):
 	curr_shards = views.shard_count
@@ -421,19 +1633,28 @@ def get_numKeys(ID):
 		if shard_to_get == views.curr_shard:
 			payload = {}
 			payload['message'] = "Key count of shard ID retrieved successfully"
-			payload['shard-id-key-count'] = len(vars.kvs_dict)
+			payload['shard-id-key-count'] = count_keys()
 			json_response = jsonify(payload)
 			response = make_response(json_response, 200)
 			return response
 		else:
-			response = requests.get('http://' + views.shard_count[shard_to_get][0] + '/key-value-store-shard/shard-id-key-count/' + ID, timeout=5)
+			response = node_client.get(views.shard_count[shard_to_get][0], '/key-value-store-shard/shard-id-key-count/' + ID)
 			json_response = jsonify(response.json())
 			response = make_response(json_response, 200)
 			return response
 
+"""
+Handle a reshard request, this node leads the reshard
+
+Works out the new layout, moving as few replicas as possible between shards,
+and sends it to every node. Then one replica of every old shard streams the keys
+that now belong to another shard straight to the replicas of that shard, while
+all nodes keep serving requests. Once every old shard is done, all nodes drop
+the keys they are no longer responsible for.
+"""
 @app.route('/key-value-store-shard/reshard', methods=['PUT'])
 def reshard():
-	json_value = request.get_json()
+	json_value = read_body()
 	new_num = int(json_value['shard-count'])
 	if (len(views.known_views) // new_num) < 2:
 		payload = {'message': "Not enough nodes to provide fault-tolerance with the given shard count!"}
@@ -441,93 +1662,161 @@ def reshard():
 		response = make_response(json_response, 400)
 		return response
 	else:
-		# Get all key/vals
-		full_kvs = dict()
-		for k,v in views.shard_count.items():
-			if k == views.curr_shard:
-				for kv, vv in vars.kvs_dict.items():
-					full_kvs[kv] = vv
-			else:
-				response = requests.get('http://' + v[0] + '/new-replica-kvs', timeout=5)
-				js_response = response.json()
-				for kv, vv in js_response.items():
-					full_kvs[kv] = vv
-
-		# Reassign all replicas to new shards
-		shard_replica_list = [[] for x in range(0, new_num)]
-		curr = 0
-		for replica in views.known_views:
-			shard_replica_list[curr].append(replica)
-
-			# Update our shard val
-			if replica == views.curr_view:
-				views.curr_shard = curr
-
-			curr+=1
-			if curr == new_num:
-				curr = 0
-
-		# Update the shard_count dict
-		views.shard_count.clear()
-		for x in range(0, new_num):
-			views.shard_count[(x+1)] = shard_replica_list[x]
-
-		# Divide the KVS
-		new_kvs_list = [{} for x in range(0, new_num+1)]
-		for k,v in full_kvs.items():
-			shard_to_be = find_shard(k)
-			print("Curr k: {} v: {} is going to shard {}".format(k,v, shard_to_be), file=sys.stderr)
-			new_kvs_list[shard_to_be][k] = v
-
-		print(new_kvs_list, file=sys.stderr)
-		#del new_kvs_list[0]
-		#print(new_kvs_list, file=sys.stderr)
-		# Update our KVS
-		#vars.kvs_dict = new_kvs_list[views.curr_shard-1]
-		vars.kvs_dict = new_kvs_list[views.curr_shard]
-
-		# Send new shard-ID, shard_count, and KVS to every replica
-		#for x in range(0, new_num):
-		for x in range(1, new_num+1):
-			payload = {'new-shard': x, 'shard_count': views.shard_count, 'kvs': new_kvs_list[x]}
-			print("Shard is {}and these keys: {}".format(x, new_kvs_list[x]), file=sys.stderr)
-			for replica_in_shard in shard_replica_list[x-1]:
-				if replica_in_shard == views.curr_view:
-					views.update_shard(x)
-					vars.kvs_dict.clear()
-					for k,v in new_kvs_list[x].items():
-						vars.kvs_dict[k] = v
-					continue
-				requests.put('http://' + replica_in_shard + '/key-value-store-shard/reshard-helper', headers=views.HEADERS, data=json.dumps(payload), timeout=8)
-		resp_payload = {'message': 'Resharding done successfully'}
+		prev_layout = views.shard_count
+		new_layout = views.plan_layout(new_num)
+
+		# Send the new layout to every node, they start routing with it right away
+		payload = {'shard_count': new_layout, 'prev_shard_count': prev_layout}
+		for view in views.known_views[:]:
+			if view == views.curr_view:
+				start_migration(new_layout, prev_layout)
+				continue
+			try:
+				node_client.put(view, '/key-value-store-shard/reshard-helper', payload)
+			except Exception as e:
+				print("Could not send the new layout to '{}'".format(view), file=sys.stderr)
+
+		# Have every old shard send away its keys, all at the same time
+		futures = dict()
+		for shard, members in prev_layout.items():
+			futures[shard] = replication.executor.submit(migrate_shard, shard, members)
+		vars.migration['shards'] = dict()
+		moved = 0
+		for shard, future in futures.items():
+			result = future.result()
+			vars.migration['shards'][shard] = result
+			moved += result['keys-sent']
+
+		for view in views.known_views[:]:
+			if view == views.curr_view:
+				finish_migration()
+				continue
+			try:
+				node_client.put(view, '/key-value-store-shard/reshard-done', {})
+			except Exception as e:
+				print("Could not finish the reshard on '{}'".format(view), file=sys.stderr)
+
+		resp_payload = {'message': 'Resharding done successfully', 'keys-moved': moved}
 		js_response = jsonify(resp_payload)
 		response=make_response(js_response, 200)
 		return response
 
+def layout_from_json(layout):
+	return {int(k): list(v) for k,v in layout.items()}
+
+def start_migration(new_layout, prev_layout):
+	views.apply_layout(new_layout, prev_layout)
+	vars.migration = {'state': 'migrating', 'shard-count': len(new_layout)}
+
+def finish_migration():
+	with vars.change_lock:
+		keys = list(vars.kvs_dict.keys())
+	for key in keys:
+		if find_shard(key) != views.curr_shard:
+			drop_kv(key)
+	views.finish_layout()
+	vars.migration['state'] = 'done'
+
+"""
+Get one replica of an old shard to send away its keys
+
+Tries the members of the shard in order until one of them does it. Returns the
+progress report of the migration.
+"""
+def migrate_shard(shard, members):
+	for member in members:
+		if member == views.curr_view:
+			return migrate_out(shard)
+		try:
+			response = node_client.put(member, '/key-value-store-shard/migrate-out', {'shard': shard}, timeout=None)
+			return node_client.load(response)['migration']
+		except Exception as e:
+			pass
+	print("No replica of shard {} could migrate its keys".format(shard), file=sys.stderr)
+	return {'shard': shard, 'keys-sent': 0, 'chunks-sent': 0, 'state': 'failed'}
+
+"""
+Send away the keys of old shard 'shard' that now belong to another shard
+
+Keys are sent in chunks of 'migration_chunk' entries, straight to the replicas
+of the new shard that were not replicas of the old one (the others already
+have the keys). The chunks are sent as they fill up, so only a chunk per
+shard is buffered at any time. Progress is kept in vars.migration.
+"""
+def migrate_out(shard):
+	old_members = views.prev_shard_count.get(shard, [])
+	old_partitioner = partitioner.build(views.prev_shard_count.keys())
+	progress = {'shard': shard, 'keys-sent': 0, 'chunks-sent': 0, 'state': 'migrating'}
+	vars.migration['outgoing'] = progress
+
+	def send_chunk(new_shard, chunk):
+		for target in views.shard_count[new_shard]:
+			if target in old_members:
+				continue
+			try:
+				node_client.put(target, '/key-value-store-shard/migrate-in', {'kvs': chunk}, timeout=30)
+			except Exception as e:
+				# Anti-entropy within the new shard will fill in the gap
+				print("Could not migrate {} keys to '{}'".format(len(chunk), target), file=sys.stderr)
+		progress['keys-sent'] += len(chunk)
+		progress['chunks-sent'] += 1
+
+	with vars.change_lock:
+		items = list(vars.kvs_dict.items())
+	buffers = dict()
+	for key, entry in items:
+		if old_partitioner.find(key) != shard:
+			continue
+		new_shard = find_shard(key)
+		if all(target in old_members for target in views.shard_count[new_shard]):
+			continue
+		chunk = buffers.setdefault(new_shard, dict())
+		chunk[key] = entry
+		if len(chunk) >= vars.migration_chunk:
+			send_chunk(new_shard, chunk)
+			buffers[new_shard] = dict()
+	for new_shard, chunk in buffers.items():
+		if len(chunk) > 0:
+			send_chunk(new_shard, chunk)
+	progress['state'] = 'done'
+	return progress
+
 @app.route('/key-value-store-shard/reshard-helper', methods=['PUT'])
 def reshard_helper():
-	json_value = request.get_json()
-	views.curr_shard = int(json_value['new-shard'])
-	views.shard_count.clear()
-	for k,v in json_value['shard_count'].items():
-		if int(k) in views.shard_count:
-			views.shard_count[int(k)].extend(v)
-		else:
-			views.shard_count[int(k)] = list()
-			views.shard_count[int(k)].extend(v)
-	vars.kvs_dict.clear()
-	for k,v in json_value['kvs'].items():
-		print("We are shard: {} and we have key: {} and val {}".format(views.curr_shard, k, v), file=sys.stderr)
-		vars.kvs_dict[k] = v
-	payload = {'message': 'updated'}
-	js_response = jsonify(payload)
+	json_value = read_body()
+	start_migration(layout_from_json(json_value['shard_count']), layout_from_json(json_value['prev_shard_count']))
+	return internal_response({'message': 'updated'})
+
+@app.route('/key-value-store-shard/migrate-out', methods=['PUT'])
+def migrate_out_helper():
+	json_value = read_body()
+	progress = migrate_out(int(json_value['shard']))
+	return internal_response({'message': 'Keys migrated', 'migration': progress})
+
+@app.route('/key-value-store-shard/migrate-in', methods=['PUT'])
+def migrate_in():
+	json_value = read_body()
+	merge_kvs(json_value['kvs'])
+	return internal_response({'message': 'Keys received'})
+
+@app.route('/key-value-store-shard/reshard-done', methods=['PUT'])
+def reshard_done():
+	finish_migration()
+	return internal_response({'message': 'Reshard finished'})
+
+"""
+Report the progress of the reshard this node is taking part in
+"""
+@app.route('/key-value-store-shard/reshard-status', methods=['GET'])
+def reshard_status():
+	js_response = jsonify(message='Reshard status retrieved successfully', migration=vars.migration)
 	response=make_response(js_response, 200)
 	return response
 			
 
 @app.route('/key-value-store-shard/add-member/<string:ID>', methods=['PUT'])
 def add_member(ID):
-	json_value = request.get_json()
+	json_value = read_body()
 	new_node = json_value['socket-address']
 	if new_node in views.known_views:
 		if int(ID) not in views.shard_count:
@@ -536,15 +1825,15 @@ def add_member(ID):
 			response = make_response(json_response, 400)
 			return response
 		else:
-			views.shard_count[int(ID)].append(new_node)
+			views.add_shard_member(int(ID), new_node)
 			for other in views.known_views:
 				if other==views.curr_view:
 					continue
 				if other==new_node:
-					requests.put('http://' + other + '/key-value-store-shard/added-to-shard/' + ID, headers=views.HEADERS, data=json.dumps(views.shard_count), timeout=10)
+					node_client.put(other, '/key-value-store-shard/added-to-shard/' + ID, views.shard_count, timeout=10)
 					pass
 				data = {'socket-address': new_node}
-				requests.put('http://' + other + '/key-value-store-shard/add-member-selfish/' + ID, headers=views.HEADERS, data=json.dumps(data), timeout=5)
+				node_client.put(other, '/key-value-store-shard/add-member-selfish/' + ID, data)
 			payload = {'message': "Success!"}
 			json_response = jsonify(payload)
 			response = make_response(json_response, 200)
@@ -557,7 +1846,7 @@ def add_member(ID):
 
 @app.route('/key-value-store-shard/add-member-selfish/<string:ID>', methods=['PUT'])
 def add_member_selfish(ID):
-	json_value = request.get_json()
+	json_value = read_body()
 	new_node = json_value['socket-address']
 	if new_node in views.known_views:
 		if int(ID) not in views.shard_count:
@@ -566,7 +1855,7 @@ def add_member_selfish(ID):
 			response = make_response(json_response, 400)
 			return response
 		else:
-			views.shard_count[int(ID)].append(new_node)
+			views.add_shard_member(int(ID), new_node)
 			payload = {'message': "Success!"}
 			json_response = jsonify(payload)
 			response = make_response(json_response, 200)
@@ -579,20 +1868,22 @@ def add_member_selfish(ID):
 
 @app.route('/key-value-store-shard/added-to-shard/<string:ID>', methods=['PUT'])
 def added_to_shard(ID):
-	json_value = request.get_json()
+	json_value = read_body()
 	nd = dict()
 	for k,v in json_value.items():
 		nd[int(k)] = v
-	views.shard_count = nd
-	views.curr_shard = int(ID)
+	views.apply_layout(nd, views.prev_shard_count)
 	update_dicts()
-	payload = {'message': "Success!"}
-	json_response = jsonify(payload)
-	response = make_response(json_response, 200)
-	return response
+	return internal_response({'message': "Success!"})
 		
 
-if __name__ ==  '__main__':
+"""
+Set up this node from the environment and start its background threads
+
+Returns the WSGI app, ready to be served. Must run in the process that serves
+the requests, since the threads don't survive a fork.
+"""
+def bootstrap():
 	# Get the socket address from the env variable and split it to IP and port
 	#sock_addr = "127.0.0.1:8085"
 	sock_addr = os.environ.get('SOCKET_ADDRESS')
@@ -609,7 +1900,51 @@ if __name__ ==  '__main__':
 		num_shards = num_shards.replace('"','')
 		ret_mess = views.verify_shards(int(num_shards))
 		print(ret_mess)
-	
+
+	# How keys are mapped to shards, 'ring' (consistent hashing) by default
+	partitioner_kind = os.environ.get('PARTITIONER')
+	if partitioner_kind is not None:
+		partitioner.kind = partitioner_kind.replace('"','')
+
+	# Number of replicas a write waits for, half the shard rounded up by default
+	write_quorum = os.environ.get('WRITE_QUORUM')
+	if write_quorum is not None:
+		replication.write_quorum = int(write_quorum.replace('"',''))
+
+	# Number of values of other shards cached for reads, off (0) by default
+	read_cache_size = os.environ.get('READ_CACHE_SIZE')
+	if read_cache_size is not None:
+		cache.capacity = int(read_cache_size.replace('"',''))
+	read_cache_ttl = os.environ.get('READ_CACHE_TTL')
+	if read_cache_ttl is not None:
+		cache.ttl = float(read_cache_ttl.replace('"',''))
+
+	# Time a deleted key is remembered before it is forgotten
+	tombstone_ttl = os.environ.get('TOMBSTONE_TTL')
+	if tombstone_ttl is not None:
+		vars.tombstone_ttl = float(tombstone_ttl.replace('"',''))
+
+
+	# Keep the state on disk when a data directory is given, only in memory otherwise
+	data_dir = os.environ.get('DATA_DIR')
+	if data_dir is not None:
+		data_dir = data_dir.replace('"','')
+
+	# Where the KVS is held, 'memory' (a dict) by default or 'lsm' for more keys than fit in memory
+	storage_engine = os.environ.get('STORAGE_ENGINE')
+	if storage_engine is not None:
+		vars.kvs_dict = engine.open_engine(storage_engine.replace('"',''), data_dir)
+
+	if data_dir is not None:
+		fsync_mode = os.environ.get('WAL_FSYNC')
+		if fsync_mode is not None:
+			storage.fsync_mode = fsync_mode.replace('"','')
+		fsync_interval = os.environ.get('WAL_FSYNC_INTERVAL')
+		if fsync_interval is not None:
+			storage.fsync_interval = float(fsync_interval.replace('"',''))
+		recover_state(data_dir)
+		snapshot_thread = threading.Thread(target=snapshot_forever, daemon=True)
+		snapshot_thread.start()
 
 	#add node to shard
 	#views.add_to_Shard(sock_addr)
@@ -620,8 +1955,7 @@ if __name__ ==  '__main__':
 		for initial_view in initial_views.split(','):
 			if initial_view == '':
 				continue
-			views.known_views.append(initial_view)
-			views.alive_views.append(initial_view)
+			views.add_view(initial_view)
 			# Add node to shard
 			if num_shards is not None:
 				views.add_to_Shard(initial_view)
@@ -629,18 +1963,48 @@ if __name__ ==  '__main__':
 	print(str(views.curr_shard))
 	views.send_new(views.curr_view)
 
-	# Update the dictionaries to the newest possible
-	dict_thread = threading.Thread(target=update_dicts)
+	# Send the writes other nodes missed once they are back
+	hints_thread = threading.Thread(target=hints.replay_forever, daemon=True)
+	hints_thread.start()
+
+	# Forget deleted keys once every replica had time to hear about the delete
+	tombstone_thread = threading.Thread(target=expire_tombstones_forever, daemon=True)
+	tombstone_thread.start()
+
+	# Catch up with the shard before serving, which also tells a restarted node how many writes it made before
+	update_dicts()
+
+	# Keep the dictionaries up to date in the background
+	dict_thread = threading.Thread(target=sync_dicts, daemon=True)
 	dict_thread.start()
 
 	# Start thread to tell others i exist
-	newbie_thread = threading.Thread(target=views.im_new)
+	newbie_thread = threading.Thread(target=views.im_new, daemon=True)
 	newbie_thread.start()
 
 	# Start the thread to verify periodically
-	new_thread = threading.Thread(target=views.verify_views)
+	new_thread = threading.Thread(target=views.verify_views, daemon=True)
 	new_thread.start()
 
-	# Start the flask app
+	return app
+
+if __name__ ==  '__main__':
+	sock_addr = os.environ.get('SOCKET_ADDRESS')
+	if sock_addr is None:
+		print("No socket address specified! Exit", file=sys.stderr)
+		sys.exit(1)
+
+	# Number of threads serving requests, and the server to use (gunicorn when installed)
+	threads = os.environ.get('THREADS')
+	if threads is not None:
+		serve.threads = int(threads.replace('"',''))
+	server = os.environ.get('SERVER')
+	if server is not None:
+		serve.server = server.replace('"','')
+	workers = os.environ.get('WORKERS')
+	if workers is not None:
+		serve.workers = int(workers.replace('"',''))
+
+	# Start serving, the node is set up in the process that serves
 	addr_parts = sock_addr.split(':')
-	app.run(host=addr_parts[0], debug=True, port=int(addr_parts[1]))
\ No newline at end of file
+	serve.run(bootstrap, addr_parts[0], int(addr_parts[1]))
\ No newline at end of file
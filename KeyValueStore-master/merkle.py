@@ -0,0 +1,82 @@
+import hashlib
+import json
+
+# Number of levels below the root, the tree has 2**DEPTH leaf buckets
+DEPTH = 8
+
+
+def digest(data):
+    return int.from_bytes(hashlib.blake2b(data.encode(), digest_size=8).digest(), 'big')
+
+
+def entry_digest(key, entry):
+    return digest(key + '\0' + json.dumps(entry))
+
+
+"""
+Merkle tree over the keys of one shard
+
+Keys are hashed into 2**depth leaf buckets. A leaf holds the XOR of the digests
+of its entries, so a single write only has to XOR out the old entry, XOR in the
+new one and rehash the path up to the root. Two replicas holding the same data
+have the same root, and when they don't, comparing the tree level by level
+finds the buckets that differ without transferring the keys themselves.
+
+levels[0] holds the root, levels[depth] the leaf buckets. The children of node
+i on one level are nodes 2i and 2i+1 on the level below.
+"""
+class MerkleTree:
+    def __init__(self, depth=DEPTH):
+        self.depth = depth
+        self.levels = [[0] * (2 ** level) for level in range(depth + 1)]
+        # The keys in every leaf bucket, so a bucket can be sent without a scan
+        self.buckets = [set() for i in range(2 ** depth)]
+
+    def bucket(self, key):
+        return digest(key) % len(self.buckets)
+
+    def root(self):
+        return self.levels[0][0]
+
+    # Apply a change of 'key' from entry 'old' (None if absent) to entry 'new'
+    def update(self, key, old, new):
+        index = self.bucket(key)
+        leaf = self.levels[self.depth][index]
+        if old is not None:
+            leaf ^= entry_digest(key, old)
+        if new is not None:
+            leaf ^= entry_digest(key, new)
+            self.buckets[index].add(key)
+        else:
+            self.buckets[index].discard(key)
+        self.levels[self.depth][index] = leaf
+        self.rehash_path(index)
+
+    def rehash_path(self, index):
+        for level in range(self.depth - 1, -1, -1):
+            index //= 2
+            left = self.levels[level + 1][2 * index]
+            right = self.levels[level + 1][2 * index + 1]
+            self.levels[level][index] = digest('{}:{}'.format(left, right))
+
+    def rebuild(self, kvs):
+        self.levels = [[0] * (2 ** level) for level in range(self.depth + 1)]
+        self.buckets = [set() for i in range(2 ** self.depth)]
+        leaves = self.levels[self.depth]
+        for key, entry in kvs.items():
+            index = self.bucket(key)
+            leaves[index] ^= entry_digest(key, entry)
+            self.buckets[index].add(key)
+        for level in range(self.depth - 1, -1, -1):
+            below = self.levels[level + 1]
+            for index in range(len(self.levels[level])):
+                self.levels[level][index] = digest('{}:{}'.format(below[2 * index], below[2 * index + 1]))
+
+    def hashes(self, level, nodes):
+        return [self.levels[level][node] for node in nodes]
+
+    def keys_in(self, buckets):
+        keys = []
+        for index in buckets:
+            keys.extend(self.buckets[index])
+        return keys
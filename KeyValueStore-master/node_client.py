@@ -0,0 +1,151 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import codec
+
+# Raised when a node can't be connected to
+ConnectionFailed = requests.exceptions.ConnectionError
+# Time to wait for another node when the caller doesn't say otherwise (seconds)
+timeout = 5
+# Number of connections kept open to every other node
+pool_size = 16
+
+# view -> requests.Session holding the keep-alive connections to that view
+sessions = dict()
+# view -> number of requests sent and number of them that failed
+counters = dict()
+sessions_lock = threading.Lock()
+# view -> (whether it takes MessagePack, compression it decodes), learned from its answers
+peers = dict()
+# What a view not heard from yet is taken to take, every node decodes zlib
+default_peer = (False, 'deflate')
+
+
+"""
+Get the session used to talk to a view, creating it on first use
+
+Every view gets its own session with its own connection pool, so connections
+are kept open and reused between requests instead of connecting every time.
+"""
+def session_for(view):
+    with sessions_lock:
+        session = sessions.get(view)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+            sessions[view] = session
+            counters[view] = {'requests': 0, 'errors': 0}
+        return session
+
+
+# Count a request sent to a view, or one that failed
+def count_request(view, failed=False):
+    session_for(view)
+    counters[view]['errors' if failed else 'requests'] += 1
+
+
+"""
+Send a request to another node
+
+'payload' is sent as the body, encoded for the node (see encode()). Any other
+keyword argument is handed to requests as is. Raises the same exceptions
+requests does.
+"""
+def request(method, view, path, payload=None, **kwargs):
+    session = session_for(view)
+    kwargs.setdefault('timeout', timeout)
+    headers = {'accept': codec.accept()}
+    if payload is not None:
+        kwargs['data'], body_headers = encode(view, payload)
+        headers.update(body_headers)
+    headers.update(kwargs.get('headers') or {})
+    kwargs['headers'] = headers
+    count_request(view)
+    try:
+        response = session.request(method, 'http://' + view + path, **kwargs)
+    except Exception:
+        count_request(view, failed=True)
+        raise
+    learn(view, response.headers)
+    return response
+
+
+"""
+Encode 'payload' for a view, returns the body and its headers
+
+MessagePack if the view answered in it before, JSON otherwise, compressed
+when large with the best compression both ends have (see codec.py).
+"""
+def encode(view, payload):
+    binary, encoding = peers.get(view, default_peer)
+    return codec.wrap(codec.dumps(payload, binary), binary, encoding)
+
+# Remember what a view takes, from the headers of an answer of an internal endpoint
+def learn(view, headers):
+    accepted = headers.get('Accept-Encoding')
+    if accepted is None:
+        # Only internal endpoints say, any other answer tells nothing
+        return
+    binary = headers.get('Content-Type', '').startswith(codec.MSGPACK)
+    peers[view] = (binary and codec.msgpack is not None, codec.pick_encoding(accepted))
+
+# The value an answer of another node carries, whichever encoding it is in
+def load(response):
+    return codec.loads(response.content, response.headers.get('Content-Type'))
+
+
+def get(view, path, **kwargs):
+    return request('GET', view, path, **kwargs)
+
+
+def put(view, path, payload=None, **kwargs):
+    return request('PUT', view, path, payload, **kwargs)
+
+
+def delete(view, path, payload=None, **kwargs):
+    return request('DELETE', view, path, payload, **kwargs)
+
+
+"""
+Send a GET for an answer streamed as a sequence of values
+
+NDJSON, or MessagePack values one after the other when both ends have msgpack,
+possibly compressed. Yields the values as they arrive, so neither the whole
+answer nor its decoded form ever has to fit in memory. Raises like request()
+does, and on an answer that isn't 200.
+"""
+def stream(view, path, **kwargs):
+    kwargs['headers'] = {'accept': codec.accept_stream(), 'accept-encoding': ', '.join(codec.encodings)}
+    kwargs['stream'] = True
+    with get(view, path, **kwargs) as response:
+        response.raise_for_status()
+        reader = codec.StreamReader(response.headers.get('Content-Type'), response.headers.get('Content-Encoding'))
+        # Read as sent, the compression is undone by the reader
+        for chunk in response.raw.stream(65536, decode_content=False):
+            for value in reader.feed(chunk):
+                yield value
+
+
+"""
+Report, for every view we talked to, how many requests were sent and how many
+connections had to be opened for them
+"""
+def metrics():
+    report = dict()
+    with sessions_lock:
+        views = list(sessions.items())
+    for view, session in views:
+        pools = session.get_adapter('http://' + view).poolmanager.pools
+        connections = 0
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is not None:
+                connections += pool.num_connections
+        sent = counters[view]['requests']
+        report[view] = {
+            'requests': sent,
+            'errors': counters[view]['errors'],
+            'connections-opened': connections,
+            'connections-reused': max(sent - connections, 0),
+        }
+    return report
@@ -0,0 +1,75 @@
+import bisect
+import hashlib
+
+# Number of points every shard gets on the ring
+vnodes = 256
+# How keys are mapped to shards, every node has to use the same one
+kind = 'ring'
+
+
+def key_hash(key):
+    return int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+
+
+"""
+Consistent hashing ring
+
+Every shard is hashed to 'vnodes' points on a ring of 64 bit hashes, and a key
+belongs to the shard owning the first point at or after the hash of the key.
+Adding a shard only takes over the keys right before its own points, which is
+about 1/N of the keyspace, and the many points per shard keep the keys evenly
+spread.
+"""
+class HashRing:
+    def __init__(self, shard_ids):
+        points = []
+        for shard in shard_ids:
+            for i in range(vnodes):
+                points.append((key_hash('{}#{}'.format(shard, i)), shard))
+        points.sort()
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def find(self, key):
+        index = bisect.bisect_left(self.hashes, key_hash(key)) % len(self.hashes)
+        return self.shards[index]
+
+
+"""
+The original mapping: the sum of the ascii values of the key modulo the number
+of shards. Changing the number of shards moves almost every key.
+"""
+class ModuloPartitioner:
+    def __init__(self, shard_ids):
+        self.shard_ids = sorted(shard_ids)
+
+    def find(self, key):
+        c = 0
+        for char in str(key):
+            c += ord(char)
+        return self.shard_ids[c % len(self.shard_ids)]
+
+
+partitioners = {'ring': HashRing, 'modulo': ModuloPartitioner}
+
+# The shard IDs and partitioner of the last layout we were asked about
+cached = (None, None)
+
+
+def build(shard_ids):
+    return partitioners[kind](tuple(sorted(shard_ids)))
+
+
+"""
+Get the partitioner for a set of shard IDs
+
+Building a ring is not free, so it is only done again when the shards change.
+"""
+def for_shards(shard_ids):
+    global cached
+    shard_ids = tuple(sorted(shard_ids))
+    cached_ids, partitioner = cached
+    if cached_ids != shard_ids:
+        partitioner = build(shard_ids)
+        cached = (shard_ids, partitioner)
+    return partitioner
@@ -0,0 +1,209 @@
+import concurrent.futures
+import asyncio
+import sys
+import aio
+import codec
+import node_client
+import views
+import hints
+
+# Number of threads used for long running work, like migrating keys
+pool_size = 32
+# Time to wait for a single node to answer (seconds)
+timeout = 3
+# How many more times a node that did not answer is tried again
+retries = 3
+# Time to wait before trying a node again, multiplied by the attempt (seconds)
+retry_delay = 0.5
+# Number of acks (the local write included) a write waits for, None for half the shard rounded up
+write_quorum = None
+# Number of writes waiting for a node that sends them without waiting any longer
+batch_size = 256
+# Time a write waits for others to go in the same message (seconds)
+flush_delay = 0.0005
+
+BATCH_PATH = '/selfish-key-value-store-batch'
+
+# view -> Outbox of the writes waiting to be sent to it, only used on the event loop
+outboxes = dict()
+# Messages sent, writes they carried and their size before and after compression
+stats = {'messages': 0, 'writes': 0, 'bytes': 0, 'compressed-bytes': 0}
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+
+
+"""
+The writes waiting to be sent to one node
+
+Writes are not sent one request each. They wait here until 'batch_size' of
+them are queued, or 'flush_delay' went by, and go to the node together in one
+message for the batch endpoint. While a message is out the next one fills up,
+so a busy node gets fewer and larger messages, in the order of the writes.
+Everything here runs on the event loop.
+"""
+class Outbox:
+    def __init__(self, view):
+        self.view = view
+        self.ops = []
+        # (future, index of its first write, number of writes) of every caller waiting
+        self.waiters = []
+        self.timer = None
+        self.sending = False
+
+    # Queue writes, returns a future for the status the node answered them with
+    def push(self, ops):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, len(self.ops), len(ops)))
+        self.ops.extend(ops)
+        if len(self.ops) >= batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(flush_delay, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.sending or len(self.ops) == 0:
+            return
+        ops, waiters = self.ops, self.waiters
+        self.ops, self.waiters = [], []
+        self.sending = True
+        asyncio.ensure_future(self.deliver(ops, waiters))
+
+    # The callers are answered None if the message couldn't be sent at all
+    async def deliver(self, ops, waiters):
+        try:
+            statuses = await send(self.view, ops)
+        except Exception as e:
+            print("Could not send {} writes to '{}': {}".format(len(ops), self.view, e), file=sys.stderr)
+            statuses = None
+        finally:
+            self.sending = False
+            self.flush()
+        for future, first, count in waiters:
+            if future.done():
+                continue
+            if statuses is None:
+                future.set_result(None)
+            else:
+                # A caller's writes are answered with the worst status among them
+                future.set_result(max(statuses[first:first + count]))
+
+
+# Queue writes for a node and wait for its answer, see Outbox
+async def enqueue(view, ops):
+    outbox = outboxes.get(view)
+    if outbox is None:
+        outbox = outboxes[view] = Outbox(view)
+    return await outbox.push(ops)
+
+
+# The body and headers of a message carrying 'ops' to 'view', see node_client.encode()
+def encode(view, ops):
+    binary, encoding = node_client.peers.get(view, node_client.default_peer)
+    body = codec.dumps({'ops': ops}, binary)
+    stats['bytes'] += len(body)
+    body, headers = codec.wrap(body, binary, encoding)
+    stats['compressed-bytes'] += len(body)
+    return body, headers
+
+
+"""
+Send writes to a node in one message, trying again if it can't be reached
+
+Runs on the event loop, so writes waiting on a slow node or between two
+attempts don't hold a thread. Returns the status of every write, or None if the
+node never answered, in which case the writes are kept as hints for when it
+comes back (see hints.py). Anything below 500 is an answer, there is no point
+in repeating a request the node refused.
+"""
+async def send(view, ops):
+    body, headers = encode(view, ops)
+    stats['messages'] += 1
+    stats['writes'] += len(ops)
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            await asyncio.sleep(retry_delay * attempt)
+        try:
+            response = await aio.request('PUT', view, BATCH_PATH, body=body, headers=headers, timeout=timeout)
+            if response.status_code < 500:
+                return node_client.load(response).get('results', [response.status_code] * len(ops))
+        except Exception as e:
+            pass
+    print("Could not replicate {} writes to '{}'".format(len(ops), view), file=sys.stderr)
+    hints.add(view, ops)
+    return None
+
+
+# Longest a message can take when every attempt times out (seconds)
+def send_time():
+    return (retries + 1) * timeout + retry_delay * retries * (retries + 1) / 2
+
+
+def quorum_size(members):
+    if write_quorum is None:
+        # Half rounded up rather than a majority, so a shard of two keeps taking writes with one down
+        return (len(members) + 1) // 2
+    return min(write_quorum, len(members))
+
+
+"""
+Replicate writes to the nodes of the shard owning them
+
+'ops' are writes in the form the batch endpoint takes. They are sent to all
+members of the shard at once, and this returns as soon as enough of them
+acknowledged them all to make a quorum (this node counts if it is a member).
+The remaining members are left to finish in the background. All other nodes
+only need to hear about the writes to keep their history complete, so they are
+notified in the background without waiting. Nodes known to be down aren't sent
+anything, the writes go straight to their hints.
+
+'needed' is the number of acks to wait for instead of the quorum.
+
+Returns whether the quorum was reached, along with the statuses received so far.
+Members that haven't answered by the time every attempt could have timed out
+are given up on.
+"""
+def replicate(ops, shard, needed=None):
+    members = views.shard_count.get(shard, [])
+    if needed is None:
+        needed = quorum_size(members)
+    if views.curr_view in members:
+        needed -= 1
+
+    futures = []
+    for view in views.known_views[:]:
+        if view == views.curr_view:
+            continue
+        if view not in views.alive_views:
+            hints.add(view, ops)
+            continue
+        future = aio.submit(enqueue(view, ops))
+        if view in members:
+            futures.append(future)
+
+    statuses = []
+    acks = 0
+    if needed <= 0:
+        return True, statuses
+    # A write can wait in its outbox for the message before it to be answered
+    wait = flush_delay + 2 * send_time()
+    try:
+        for future in concurrent.futures.as_completed(futures, timeout=wait):
+            status = future.result()
+            if status is None:
+                continue
+            statuses.append(status)
+            if status < 300:
+                acks += 1
+                if acks >= needed:
+                    break
+    except concurrent.futures.TimeoutError:
+        print("Replicas of shard {} did not answer within {}s".format(shard, wait), file=sys.stderr)
+    return acks >= needed, statuses
+
+
+def metrics():
+    return dict(stats)
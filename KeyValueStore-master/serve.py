@@ -0,0 +1,72 @@
+import sys
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+# Number of threads serving requests at the same time
+threads = 32
+# Number of worker processes asked for, only one can hold the state of a node
+workers = 1
+# Server to use: 'gunicorn', 'werkzeug', or None for gunicorn when it is installed
+server = None
+# Time a gunicorn worker may go silent (starting up included) before it is restarted (seconds)
+worker_timeout = 120
+
+
+if BaseApplication is not None:
+    """
+    Gunicorn application building the node in the worker process
+
+    'setup' is only called once the worker is forked, so the background
+    threads it starts run in the process serving the requests.
+    """
+    class GunicornServer(BaseApplication):
+        def __init__(self, setup, options):
+            self.setup = setup
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                # Skip settings this version of gunicorn doesn't have
+                if name in self.cfg.settings:
+                    self.cfg.set(name, value)
+
+        def load(self):
+            return self.setup()
+
+
+"""
+Serve the app returned by 'setup' on host:port
+
+Everything a node knows (KVS, history, views, shards) lives in the memory of one
+process and is shared with its background threads, so several worker processes
+would each hold a different copy. A node is therefore always one process, and
+concurrency comes from threads: gunicorn runs one gthread worker with 'threads'
+threads, and without gunicorn the threaded werkzeug server is used, without the
+debugger and the reloader.
+"""
+def run(setup, host, port):
+    if workers > 1:
+        print("A node keeps its state in one process, ignoring {} workers".format(workers), file=sys.stderr)
+
+    use_gunicorn = server == 'gunicorn' or (server is None and BaseApplication is not None)
+    if use_gunicorn:
+        if BaseApplication is None:
+            print("gunicorn is not installed! Exit", file=sys.stderr)
+            sys.exit(1)
+        options = {
+            'bind': '{}:{}'.format(host, port),
+            'workers': 1,
+            'worker_class': 'gthread',
+            'threads': threads,
+            'timeout': worker_timeout,
+            # Several nodes may run on one host, they can't share a control socket
+            'control_socket_disable': True,
+        }
+        GunicornServer(setup, options).run()
+    else:
+        from werkzeug.serving import run_simple
+        run_simple(host, port, setup(), threaded=True)
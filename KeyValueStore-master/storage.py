@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import threading
+
+# When a write is forced to disk:
+#   'always' - the write waits until it is on disk, concurrent writes share one fsync
+#   'batch'  - writes are forced to disk together every 'fsync_interval' seconds
+#   'off'    - writes are handed to the OS, which decides when they reach the disk
+fsync_mode = 'batch'
+# Time to wait for more writes before forcing them to disk (seconds)
+fsync_interval = 0.005
+# Number of pending writes that forces them to disk without waiting any longer
+batch_size = 512
+# Number of writes after which the state is compacted into a new snapshot
+snapshot_every = 10000
+
+SNAPSHOT_FILE = 'snapshot.json'
+
+
+def segment_name(number):
+    return 'wal-{:08d}.log'.format(number)
+
+
+def segment_numbers(directory):
+    numbers = []
+    for name in os.listdir(directory):
+        if name.startswith('wal-') and name.endswith('.log'):
+            numbers.append(int(name[4:-4]))
+    return sorted(numbers)
+
+
+"""
+Append-only write-ahead log of every change made to the local state
+
+Records are JSON objects, one per line. The log is split in segments: taking a
+snapshot closes the current segment, and once the snapshot is on disk every
+segment it covers is deleted. A background thread writes the pending records
+and forces them to disk, so concurrent writers share a single fsync (group
+commit).
+"""
+class WriteAheadLog:
+    def __init__(self, directory):
+        self.directory = directory
+        existing = segment_numbers(directory)
+        # Never append to an old segment, its last line may be torn
+        self.segment = existing[-1] + 1 if len(existing) > 0 else 1
+        self.file = open(os.path.join(directory, segment_name(self.segment)), 'a', encoding='utf-8')
+        # Held while writing to the file, so a rotation can't interleave
+        self.io_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.pending = []
+        # Sequence number of the last record appended and of the last one on disk
+        self.appended = 0
+        self.durable = 0
+        self.since_snapshot = 0
+        flusher = threading.Thread(target=self.flush_forever, daemon=True)
+        flusher.start()
+
+    """
+    Add a record to the log
+
+    Returns its sequence number, to be handed to wait() once the caller released
+    whatever lock keeps the log in the same order as the changes.
+    """
+    def append(self, record):
+        with self.cond:
+            self.pending.append(json.dumps(record))
+            self.appended += 1
+            self.since_snapshot += 1
+            if len(self.pending) >= batch_size:
+                self.cond.notify_all()
+            return self.appended
+
+    # Block until record 'seq' is on disk, if writes have to wait for that
+    def wait(self, seq):
+        if fsync_mode != 'always':
+            return
+        with self.cond:
+            self.cond.notify_all()
+            while self.durable < seq:
+                self.cond.wait()
+
+    def write_pending(self):
+        with self.cond:
+            records = self.pending
+            self.pending = []
+            upto = self.appended
+        if len(records) > 0:
+            self.file.write('\n'.join(records) + '\n')
+            self.file.flush()
+            if fsync_mode != 'off':
+                os.fsync(self.file.fileno())
+        with self.cond:
+            self.durable = upto
+            self.cond.notify_all()
+
+    def flush_forever(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.pending) >= batch_size, fsync_interval)
+            with self.io_lock:
+                try:
+                    self.write_pending()
+                except Exception as e:
+                    print("Could not write to the log: {}".format(e), file=sys.stderr)
+
+    def needs_snapshot(self):
+        return self.since_snapshot >= snapshot_every
+
+    """
+    Close the current segment and start a new one
+
+    Must be called while no change can be made, so the state copied at the same
+    time matches exactly the segments up to the one returned.
+    """
+    def rotate(self):
+        with self.io_lock:
+            self.write_pending()
+            self.file.close()
+            closed = self.segment
+            self.segment += 1
+            self.file = open(os.path.join(self.directory, segment_name(self.segment)), 'a', encoding='utf-8')
+            self.since_snapshot = 0
+            return closed
+
+    """
+    Write a snapshot of 'state' covering every segment up to 'segment'
+
+    The snapshot is written next to the old one and renamed over it, so a crash
+    at any point leaves a complete snapshot behind. The segments it covers are
+    only deleted afterwards.
+    """
+    def write_snapshot(self, segment, state):
+        state['segment'] = segment
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        for number in segment_numbers(self.directory):
+            if number <= segment:
+                os.remove(os.path.join(self.directory, segment_name(number)))
+
+
+"""
+Read back the state saved in 'directory'
+
+Returns the latest snapshot (None if there is none) and the records written
+after it, in order. A torn last line, left by a crash in the middle of a write,
+ends the replay of its segment.
+"""
+def recover(directory):
+    os.makedirs(directory, exist_ok=True)
+    snapshot = None
+    covered = 0
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        covered = snapshot['segment']
+
+    records = []
+    for number in segment_numbers(directory):
+        if number <= covered:
+            continue
+        with open(os.path.join(directory, segment_name(number)), encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    return snapshot, records
@@ -0,0 +1,161 @@
+import unittest
+import collections
+import causal
+import engine
+import merkle
+import index
+import views
+import main
+
+
+class TestClocks(unittest.TestCase):
+    def test_encode_decode(self):
+        clock = {'n2:1': 3, 'n1:1': 1}
+        self.assertEqual(causal.encode(clock), 'n1:1=1,n2:1=3')
+        self.assertEqual(causal.decode('<n1:1=1,n2:1=3>'), clock)
+        self.assertEqual(causal.decode(''), {})
+        # Metadata of older versions carries no dependency
+        self.assertEqual(causal.decode('V12'), {})
+
+    def test_merge_and_descends(self):
+        a = {'n1': 2, 'n2': 1}
+        b = {'n2': 3}
+        self.assertEqual(causal.merge(a, b), {'n1': 2, 'n2': 3})
+        self.assertTrue(causal.descends(causal.merge(a, b), a))
+        self.assertFalse(causal.descends(a, b))
+        self.assertTrue(causal.descends(a, {}))
+
+
+class TestPack(unittest.TestCase):
+    def test_round_trip(self):
+        for meta in ['n1:1=1,n2:1=300', '<n2:1=0,n1:1=7>', '10.10.0.2:8085=4,10.10.0.3:8085=123456789']:
+            packed = causal.pack(meta)
+            self.assertIsInstance(packed, bytes)
+            self.assertLess(len(packed), len(meta))
+            self.assertEqual(causal.unpack(packed), meta)
+        # The same nodes share their order
+        self.assertEqual(causal.pack('n1:1=1,n2:1=300')[:1], causal.pack('n1:1=2,n2:1=3')[:1])
+
+    def test_anything_else_is_kept(self):
+        for meta in ['', '<>', 'V12', 'n1=01', 'n1=1,,n2=2', 'n1=\u00b2', None]:
+            self.assertIs(causal.pack(meta), meta)
+            self.assertIs(causal.unpack(meta), meta)
+
+
+class TestIsNewer(unittest.TestCase):
+    def test_causal_order(self):
+        self.assertTrue(causal.is_newer('n1=2', 'n1=1'))
+        self.assertFalse(causal.is_newer('n1=1', 'n1=2'))
+        self.assertTrue(causal.is_newer('n1=1,n2=1', 'n2=1'))
+        # The same write doesn't replace itself
+        self.assertFalse(causal.is_newer('n1=1', 'n1=1'))
+
+    def test_concurrent_larger_total_wins(self):
+        self.assertTrue(causal.is_newer('n1=3', 'n2=1'))
+        self.assertFalse(causal.is_newer('n2=1', 'n1=3'))
+
+    def test_concurrent_same_total_ordered_by_encoding(self):
+        self.assertTrue(causal.is_newer('n2=1', 'n1=1'))
+        self.assertFalse(causal.is_newer('n1=1', 'n2=1'))
+        # Every replica picks the same one, whatever the order the writes arrive in
+        for a, b in [('n1=2,n2=1', 'n1=1,n2=2'), ('n3=1', 'n1=1')]:
+            self.assertNotEqual(causal.is_newer(a, b), causal.is_newer(b, a))
+
+
+class TestHistory(unittest.TestCase):
+    def test_dots_fold_into_contiguous(self):
+        history = causal.History()
+        self.assertTrue(history.merge('n1', 0, [3]))
+        self.assertEqual(history['n1'], [0, [3]])
+        self.assertTrue(history.has('n1', 3))
+        self.assertFalse(history.has('n1', 1))
+        history.merge('n1', 0, [1])
+        self.assertEqual(history['n1'], [1, [3]])
+        # Filling the gap folds the dot past it in
+        history.merge('n1', 0, [2])
+        self.assertEqual(history['n1'], [3, []])
+        self.assertEqual(history.extra, {})
+        self.assertEqual(history.next_seq('n1'), 4)
+
+    def test_merge_contiguous(self):
+        history = causal.History()
+        history.merge('n1', 0, [5, 7])
+        self.assertTrue(history.merge('n1', 5, []))
+        self.assertEqual(history['n1'], [5, [7]])
+        self.assertTrue(history.merge('n1', 6, [8]))
+        self.assertEqual(history['n1'], [8, []])
+        # Nothing new
+        self.assertFalse(history.merge('n1', 4, [2]))
+
+    def test_covers(self):
+        history = causal.History()
+        history.merge('n1', 2, [])
+        history.merge('n2', 0, [2])
+        self.assertTrue(history.covers({}))
+        self.assertTrue(history.covers({'n1': 2}))
+        self.assertFalse(history.covers({'n1': 3}))
+        # Out of order dots don't count, everything before them is needed too
+        self.assertFalse(history.covers({'n2': 2}))
+        self.assertFalse(history.covers({'n3': 1}))
+
+
+class TestOrderWrite(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict(vars(main.vars))
+        self.views = (views.curr_view, views.curr_shard, views.shard_count, views.known_views)
+        views.curr_view = 'n1:1'
+        views.curr_shard = 1
+        views.shard_count = {1: ['n1:1']}
+        views.known_views = ['n1:1']
+        main.vars.kvs_dict = engine.MemoryEngine()
+        main.vars.history = causal.History()
+        main.vars.history_cond = main.threading.Condition(main.vars.change_lock)
+        main.vars.kvs_changes = {}
+        main.vars.history_changes = {}
+        main.vars.tree = merkle.MerkleTree()
+        main.vars.key_index = index.OrderedIndex()
+        main.vars.tombstones = collections.OrderedDict()
+        main.vars.wal = None
+        main.vars.dependency_wait = 0
+        self.context = main.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        for name, value in self.saved.items():
+            if not name.startswith('__'):
+                setattr(main.vars, name, value)
+        views.curr_view, views.curr_shard, views.shard_count, views.known_views = self.views
+
+    def test_new_write_replaces_concurrent_tombstone(self):
+        # Another node deleted the key, this node heard about it through synchronization
+        main.store_history('n2:1', 1, [])
+        main.store_kv('k', ['NULL', 'n2:1=1'])
+        # A client that never saw the delete writes the key again
+        response, new_meta = main.common_put('', 'back', 'k')
+        self.assertLess(response.status_code, 300)
+        self.assertEqual(causal.decode(new_meta), {'n1:1': 1, 'n2:1': 1})
+        self.assertEqual(main.vars.kvs_dict['k'].value, 'back')
+
+    def test_replicated_write_records_its_dot(self):
+        response, new_meta = main.common_put('', 'v', 'k', 'n2:1=1', 'n2:1')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(main.vars.history.has('n2:1', 1))
+        # Arriving again, it is recognized as applied
+        self.assertEqual(main.order_write('', 'n2:1=1', 'n2:1'), ('n2:1=1', True))
+
+    def test_write_without_origin_is_applied(self):
+        # Older nodes don't name the origin, the dot is the count that grew
+        self.assertEqual(main.order_write('n1:1=0', 'n2:1=1', None), ('n2:1=1', False))
+        self.assertTrue(main.vars.history.has('n2:1', 1))
+        # Can't be told apart, applied without recording a dot
+        main.store_history('n1:1', 1, [])
+        self.assertEqual(main.order_write('', 'n1:1=1,n3:1=1', None), ('n1:1=1,n3:1=1', False))
+        self.assertFalse(main.vars.history.has('n3:1', 1))
+
+    def test_missing_dependency_is_refused(self):
+        self.assertEqual(main.order_write('n2:1=1', None, None), (None, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+import unittest
+import tempfile
+import shutil
+import time
+import threading
+import os
+import engine
+
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = engine.BloomFilter(1000)
+        keys = ['key%d' % i for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(bloom.may_contain(key) for key in keys))
+        # About 1% false positives with 10 bits per key
+        false_positives = sum(1 for i in range(1000) if bloom.may_contain('other%d' % i))
+        self.assertLess(false_positives, 50)
+
+
+class TestMemoryEngine(unittest.TestCase):
+    def test_entries_come_back_as_written(self):
+        kvs = engine.MemoryEngine()
+        kvs['a'] = engine.Entry('1', 'n1:1=1,n2:1=2')
+        kvs['b'] = engine.Entry('NULL', '<n1:1=3>')
+        kvs['c'] = engine.Entry('3', '')
+        self.assertEqual(kvs['a'], ('1', 'n1:1=1,n2:1=2'))
+        self.assertEqual(kvs.get('b').meta, '<n1:1=3>')
+        self.assertEqual(dict(kvs.items()), kvs.checkpoint())
+        self.assertEqual(kvs.pop('c'), ('3', ''))
+        self.assertIsNone(kvs.get('c'))
+        self.assertEqual(sorted(kvs), ['a', 'b'])
+        # Held packed
+        self.assertIsInstance(kvs.entries['a'][1], bytes)
+
+
+class TestSSTable(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='kvs-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_index_lookup(self):
+        items = [('key%04d' % i, ['v%d' % i, '']) for i in range(100)]
+        items.append(('key9999', None))
+        table = engine.SSTable.write(os.path.join(self.directory, 'sst-00000001.sst'), items)
+        self.assertEqual(len(table.index_keys), -(-len(items) // engine.index_interval))
+        # First and last keys of a block, and keys in between
+        for i in (0, 15, 16, 17, 63, 99):
+            self.assertEqual(table.lookup('key%04d' % i), (True, ['v%d' % i, '']))
+        self.assertEqual(table.lookup('key9999'), (True, None))
+        self.assertEqual(table.lookup('key0050x'), (False, None))
+        self.assertEqual(table.lookup('a'), (False, None))
+        self.assertEqual(list(table.items()), [(key, entry) for key, entry in items])
+
+
+class TestLSMEngine(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='kvs-test-')
+        self.settings = (engine.memtable_limit, engine.compaction_trigger)
+        engine.memtable_limit = 10
+        engine.compaction_trigger = 4
+
+    def tearDown(self):
+        engine.memtable_limit, engine.compaction_trigger = self.settings
+        shutil.rmtree(self.directory)
+
+    def open(self):
+        return engine.LSMEngine(self.directory)
+
+    def tables(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.sst'))
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_memtable_flush(self):
+        kvs = self.open()
+        for i in range(10):
+            kvs['key%d' % i] = engine.Entry('v%d' % i, '')
+        # Full, frozen and written out in the background
+        self.assertEqual(len(kvs.memtable), 0)
+        kvs.sync()
+        self.assertEqual(len(self.tables()), 1)
+        self.assertEqual(kvs.get('key3'), ['v3', ''])
+        self.assertEqual(len(kvs), 10)
+
+    def test_lookup_after_delete(self):
+        kvs = self.open()
+        for i in range(10):
+            kvs['key%d' % i] = engine.Entry('v%d' % i, '')
+        kvs.sync()
+        self.assertEqual(kvs.pop('key3'), ['v3', ''])
+        self.assertIsNone(kvs.get('key3'))
+        self.assertNotIn('key3', kvs)
+        self.assertIsNone(kvs.pop('key3'))
+        with self.assertRaises(KeyError):
+            kvs['key3']
+        self.assertEqual(len(kvs), 9)
+        # The deletion hides the key once it is written out too
+        kvs.checkpoint()
+        kvs.sync()
+        self.assertIsNone(kvs.get('key3'))
+        self.assertNotIn('key3', list(kvs.keys()))
+
+    def test_newest_entry_wins(self):
+        kvs = self.open()
+        kvs['a'] = engine.Entry('1', '')
+        kvs.checkpoint()
+        kvs.sync()
+        kvs['a'] = engine.Entry('2', '')
+        self.assertEqual(kvs['a'], ('2', ''))
+        kvs.checkpoint()
+        kvs.sync()
+        self.assertEqual(kvs['a'], ['2', ''])
+        self.assertEqual(list(kvs.items()), [('a', ['2', ''])])
+
+    def test_compaction_drops_deletions(self):
+        kvs = self.open()
+        for i in range(10):
+            kvs['key%d' % i] = engine.Entry('v%d' % i, '')
+        kvs.checkpoint()
+        for i in range(5):
+            kvs.pop('key%d' % i)
+        kvs.checkpoint()
+        kvs['key9'] = engine.Entry('new', '')
+        kvs.checkpoint()
+        kvs['extra'] = engine.Entry('x', '')
+        kvs.checkpoint()
+        kvs.sync()
+        self.wait_for(lambda: len(kvs.tables) == 1)
+        self.wait_for(lambda: len(self.tables()) == 1)
+
+        items = list(kvs.tables[0].items())
+        self.assertEqual([key for key, entry in items], ['extra', 'key5', 'key6', 'key7', 'key8', 'key9'])
+        self.assertTrue(all(entry is not None for key, entry in items))
+        self.assertEqual(kvs.get('key9'), ['new', ''])
+        self.assertIsNone(kvs.get('key0'))
+
+    def test_readers_overlapping_compactions(self):
+        engine.memtable_limit = 20
+        kvs = self.open()
+        for i in range(100):
+            kvs['key%03d' % i] = engine.Entry('v', '')
+        errors = []
+        done = threading.Event()
+
+        def read():
+            try:
+                while not done.is_set():
+                    for key, entry in kvs.items():
+                        kvs.get(key)
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        for reader in readers:
+            reader.start()
+        for i in range(2000):
+            kvs['key%03d' % (i % 300)] = engine.Entry('v%d' % i, '')
+        kvs.sync()
+        done.set()
+        for reader in readers:
+            reader.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(kvs), 300)
+
+    def test_reopen(self):
+        # No compaction still running when the directory is removed
+        engine.compaction_trigger = 100
+        kvs = self.open()
+        for i in range(25):
+            kvs['key%02d' % i] = engine.Entry('v%d' % i, '')
+        kvs.pop('key07')
+        kvs.checkpoint()
+        kvs.sync()
+
+        reopened = self.open()
+        self.assertEqual(len(reopened), 24)
+        self.assertEqual(reopened.get('key24'), ['v24', ''])
+        self.assertIsNone(reopened.get('key07'))
+        self.assertEqual([key for key, entry in reopened.items()], ['key%02d' % i for i in range(25) if i != 7])
+        # New tables go after the ones found on disk
+        reopened['later'] = engine.Entry('x', '')
+        reopened.checkpoint()
+        reopened.sync()
+        self.assertEqual(self.open().get('later'), ['x', ''])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import asyncio
+import replication
+import views
+import aio
+
+
+class TestReplicate(unittest.TestCase):
+    def setUp(self):
+        self.saved = (replication.send, replication.timeout, replication.retries, replication.retry_delay)
+        self.views = (views.curr_view, views.shard_count, views.known_views, views.alive_views)
+        views.curr_view = 'n1:1'
+        views.shard_count = {1: ['n1:1', 'n2:1', 'n3:1']}
+        views.known_views = ['n1:1', 'n2:1', 'n3:1']
+        views.alive_views = ['n1:1', 'n2:1', 'n3:1']
+        replication.outboxes.clear()
+
+    def tearDown(self):
+        replication.send, replication.timeout, replication.retries, replication.retry_delay = self.saved
+        views.curr_view, views.shard_count, views.known_views, views.alive_views = self.views
+        aio.submit(self.clear_outboxes()).result()
+
+    async def clear_outboxes(self):
+        replication.outboxes.clear()
+
+    def test_send_failure_answers_the_callers(self):
+        async def send(view, ops):
+            raise ValueError("can't encode")
+        replication.send = send
+        self.assertEqual(replication.replicate([{'key': 'k'}], 1, needed=3), (False, []))
+        # The outbox isn't stuck, the next writes go out
+        async def send(view, ops):
+            return [200] * len(ops)
+        replication.send = send
+        self.assertEqual(replication.replicate([{'key': 'k'}], 1, needed=3), (True, [200, 200]))
+
+    def test_gives_up_on_members_that_never_answer(self):
+        replication.timeout, replication.retries, replication.retry_delay = 0.05, 0, 0
+        async def send(view, ops):
+            if view == 'n3:1':
+                await asyncio.sleep(10)
+            return [200] * len(ops)
+        replication.send = send
+        self.assertEqual(replication.replicate([{'key': 'k'}], 1, needed=3), (False, [200]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import collections
+import engine
+import index
+import merkle
+import views
+import main
+
+
+# Keys k00 to k39 held by this node, some of shard 1 (its own) and some of shard 2
+class ScanFixture(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict(vars(main.vars))
+        self.views = (views.curr_view, views.curr_shard, views.shard_count, views.prev_shard_count)
+        self.scan_shard = main.scan_shard
+        views.curr_view = 'n1:1'
+        views.curr_shard = 1
+        views.shard_count = {1: ['n1:1'], 2: ['n2:1']}
+        views.prev_shard_count = {}
+        main.vars.kvs_dict = engine.MemoryEngine()
+        main.vars.key_index = index.OrderedIndex()
+        main.vars.tree = merkle.MerkleTree()
+        main.vars.tombstones = collections.OrderedDict()
+        main.vars.kvs_changes = {}
+        main.vars.wal = None
+        self.owned = []
+        for i in range(40):
+            key = 'k%02d' % i
+            main.vars.kvs_dict[key] = engine.Entry('v%d' % i, 'n1:1=%d' % (i + 1))
+            main.vars.key_index.add(key)
+            if main.find_shard(key) == 1:
+                self.owned.append(key)
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            if not name.startswith('__'):
+                setattr(main.vars, name, value)
+        views.curr_view, views.curr_shard, views.shard_count, views.prev_shard_count = self.views
+        main.scan_shard = self.scan_shard
+
+    def args(self, limit, after=None):
+        return {'prefix': 'k', 'start': None, 'end': None, 'after': after, 'limit': limit}
+
+
+class TestScanLocal(ScanFixture):
+    def test_page_is_filled_past_keys_of_other_shards(self):
+        # Keys of the other shard are still here, as right after a reshard
+        entries, more = main.scan_local(self.args(5))
+        self.assertEqual([entry[0] for entry in entries], self.owned[:5])
+        self.assertTrue(more)
+        entries, more = main.scan_local(self.args(100))
+        self.assertEqual([entry[0] for entry in entries], self.owned)
+        self.assertFalse(more)
+
+    def test_key_count_only_counts_live_owned_keys(self):
+        main.store_kv(self.owned[0], ['NULL', 'n1:1=50'])
+        with main.app.test_client() as client:
+            answer = client.get('/key-value-store-shard/shard-id-key-count/1').get_json()
+        self.assertEqual(answer['shard-id-key-count'], len(self.owned) - 1)
+
+    def test_keys_not_migrated_yet_come_from_previous_owners(self):
+        views.prev_shard_count = {1: ['n3:1'], 2: ['n2:1']}
+        views.shard_count = {1: ['n1:1'], 2: ['n2:1']}
+        main.vars.kvs_dict.pop(self.owned[1])
+        main.vars.key_index.discard(self.owned[1])
+        previous = [[key, 'old', 'n3:1=1'] for key in self.owned[:4]]
+        async def scan_shard(shard, args, layout=None, owner=None):
+            self.assertEqual((layout, owner), (views.prev_shard_count, 1))
+            return previous, True
+        main.scan_shard = scan_shard
+        entries, more = main.scan_local(self.args(10))
+        # This node's own entries win, and nothing past the last key of the previous owner is vouched for
+        self.assertEqual([entry[0] for entry in entries], self.owned[:4])
+        self.assertEqual(entries[1][1], 'old')
+        self.assertEqual(entries[0][1], main.vars.kvs_dict[self.owned[0]].value)
+        self.assertTrue(more)
+
+
+
+class TestScanEndpoint(ScanFixture):
+    def setUp(self):
+        super().setUp()
+        # Shard 2 answers with the keys of the fixture it owns
+        others = [[key, 'v', 'n2:1=1'] for key in sorted(main.vars.kvs_dict.keys()) if key not in self.owned]
+        async def scan_shard(shard, args, layout=None, owner=None):
+            page = [entry for entry in others if args['after'] is None or entry[0] > args['after']]
+            return page[:args['limit']], len(page) > args['limit']
+        main.scan_shard = scan_shard
+
+    def scan(self, query):
+        with main.app.test_client() as client:
+            return client.get('/key-value-store-scan?' + query).get_json()
+
+    def test_page_cut_at_limit_has_a_cursor(self):
+        # Each shard has fewer keys than the limit, together they have more
+        self.assertLess(len(self.owned), 30)
+        answer = self.scan('prefix=k&limit=30')
+        self.assertEqual(len(answer['entries']), 30)
+        self.assertEqual(answer['cursor'], answer['entries'][-1]['key'])
+        rest = self.scan('prefix=k&limit=30&cursor=' + answer['cursor'])
+        self.assertIsNone(rest['cursor'])
+        keys = [entry['key'] for entry in answer['entries'] + rest['entries']]
+        self.assertEqual(keys, sorted(main.vars.kvs_dict.keys()))
+
+    def test_last_page_has_no_cursor(self):
+        answer = self.scan('prefix=k&limit=100')
+        self.assertEqual(len(answer['entries']), 40)
+        self.assertIsNone(answer['cursor'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+import collections
+import storage
+import engine
+import causal
+import merkle
+import index
+import main
+
+
+def write_lines(path, lines):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(''.join(lines))
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='kvs-test-')
+        self.fsync_mode = storage.fsync_mode
+        storage.fsync_mode = 'always'
+
+    def tearDown(self):
+        storage.fsync_mode = self.fsync_mode
+        shutil.rmtree(self.directory)
+
+    def test_records_come_back_in_order(self):
+        wal = storage.WriteAheadLog(self.directory)
+        for i in range(5):
+            wal.wait(wal.append({'k': 'key%d' % i, 'e': ['v%d' % i, '']}))
+        snapshot, records = storage.recover(self.directory)
+        self.assertIsNone(snapshot)
+        self.assertEqual([r['k'] for r in records], ['key%d' % i for i in range(5)])
+
+    def test_snapshot_plus_tail(self):
+        wal = storage.WriteAheadLog(self.directory)
+        wal.wait(wal.append({'k': 'a', 'e': ['1', '']}))
+        segment = wal.rotate()
+        wal.write_snapshot(segment, {'kvs': {'a': ['1', '']}, 'history': {}})
+        wal.wait(wal.append({'k': 'b', 'e': ['2', '']}))
+
+        snapshot, records = storage.recover(self.directory)
+        self.assertEqual(snapshot['kvs'], {'a': ['1', '']})
+        self.assertEqual(snapshot['segment'], segment)
+        self.assertEqual(records, [{'k': 'b', 'e': ['2', '']}])
+        # The segments the snapshot covers are gone
+        self.assertEqual(storage.segment_numbers(self.directory), [segment + 1])
+
+    def test_torn_last_line(self):
+        write_lines(os.path.join(self.directory, storage.segment_name(1)), [
+            json.dumps({'k': 'a', 'e': ['1', '']}) + '\n',
+            '{"k": "b", "e": ["2', # Cut in the middle of the write
+        ])
+        snapshot, records = storage.recover(self.directory)
+        self.assertEqual(records, [{'k': 'a', 'e': ['1', '']}])
+
+        # A log opened afterwards starts a new segment, which is replayed after the torn one
+        wal = storage.WriteAheadLog(self.directory)
+        self.assertEqual(wal.segment, 2)
+        wal.wait(wal.append({'k': 'c', 'e': ['3', '']}))
+        snapshot, records = storage.recover(self.directory)
+        self.assertEqual([r['k'] for r in records], ['a', 'c'])
+
+    def test_snapshot_is_never_torn(self):
+        wal = storage.WriteAheadLog(self.directory)
+        wal.write_snapshot(wal.rotate(), {'kvs': {'a': ['1', '']}, 'history': {}})
+        # A crash while writing the next snapshot leaves only its temporary file
+        write_lines(os.path.join(self.directory, storage.SNAPSHOT_FILE + '.tmp'), ['{"kvs": {'])
+        snapshot, records = storage.recover(self.directory)
+        self.assertEqual(snapshot['kvs'], {'a': ['1', '']})
+
+
+class TestRecoverState(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='kvs-test-')
+        self.saved = dict(vars(main.vars))
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            if not name.startswith('__'):
+                setattr(main.vars, name, value)
+        shutil.rmtree(self.directory)
+
+    def reset(self, kvs):
+        main.vars.kvs_dict = kvs
+        main.vars.history = causal.History()
+        main.vars.version = 0
+        main.vars.kvs_changes = {}
+        main.vars.history_changes = {}
+        main.vars.tree = merkle.MerkleTree()
+        main.vars.key_index = index.OrderedIndex()
+        main.vars.tombstones = collections.OrderedDict()
+        main.vars.wal = None
+
+    def write_state(self, snapshot_kvs):
+        write_lines(os.path.join(self.directory, storage.SNAPSHOT_FILE), [json.dumps({
+            'segment': 1,
+            'kvs': snapshot_kvs,
+            'history': {'n1:1': [2, []]},
+        })])
+        # Covered by the snapshot, must not be replayed
+        write_lines(os.path.join(self.directory, storage.segment_name(1)), [
+            json.dumps({'k': 'stale', 'e': ['old', '<n1:1=1>']}) + '\n',
+        ])
+        write_lines(os.path.join(self.directory, storage.segment_name(2)), [
+            json.dumps({'k': 'b', 'e': ['2', '<n1:1=3>']}) + '\n',
+            json.dumps({'h': 'n1:1', 'c': 3, 'x': [5]}) + '\n',
+            json.dumps({'k': 'a', 'e': ['NULL', '<n1:1=5>']}) + '\n',
+            json.dumps({'d': 'c'}) + '\n',
+            '{"k": "torn", "e": [',
+        ])
+
+    def check_recovered(self):
+        kvs = main.vars.kvs_dict
+        self.assertEqual(kvs.get('a'), ('NULL', '<n1:1=5>'))
+        self.assertEqual(kvs.get('b'), ('2', '<n1:1=3>'))
+        self.assertIsNone(kvs.get('c'))
+        self.assertIsNone(kvs.get('stale'))
+        self.assertIsNone(kvs.get('torn'))
+        self.assertEqual(main.vars.history.to_json()['n1:1'], [3, [5]])
+        self.assertEqual(main.vars.key_index.scan(limit=10), ['b'])
+        self.assertIn('a', main.vars.tombstones)
+        self.assertIsNotNone(main.vars.wal)
+
+    def test_memory_engine(self):
+        self.reset(engine.MemoryEngine())
+        self.write_state({'a': ['1', '<n1:1=1>'], 'c': ['3', '<n1:1=2>']})
+        main.recover_state(self.directory)
+        self.check_recovered()
+
+    def test_lsm_engine(self):
+        # The LSM engine keeps its entries itself, the snapshot holds none
+        tables = engine.LSMEngine(os.path.join(self.directory, 'lsm'))
+        tables['a'] = engine.Entry('1', '<n1:1=1>')
+        tables['c'] = engine.Entry('3', '<n1:1=2>')
+        tables['gone'] = engine.Entry('NULL', '<n1:1=1>')
+        tables.checkpoint()
+        tables.sync()
+
+        self.reset(engine.LSMEngine(os.path.join(self.directory, 'lsm')))
+        self.write_state(None)
+        main.recover_state(self.directory)
+        self.check_recovered()
+        # Tombstones found in the tables expire like the others
+        self.assertIn('gone', main.vars.tombstones)
+
+
+if __name__ == '__main__':
+    unittest.main()
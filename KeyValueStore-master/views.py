@@ -1,7 +1,12 @@
-import requests
 import time
 import sys
-import json
+import math
+import random
+import asyncio
+import threading
+import concurrent.futures
+import node_client
+import aio
 
 # Standard headers when dealing with posting data
 HEADERS = {'content-type': 'application/json'}
@@ -10,8 +15,8 @@ HEADERS = {'content-type': 'application/json'}
 kvs = dict()
 # List storing all views that we know about (just the IP and port)
 known_views = list()
-# Time to wait before checking all views again (seconds)
-sleep_time = 45
+# Time between two rounds of probes (seconds)
+sleep_time = 0.2
 # The current view ip and port
 curr_view = ''
 # List of alive views that are reachable
@@ -20,44 +25,244 @@ alive_views = []
 shard_count = {}
 # The shard group that we are a part of
 curr_shard = 0
+# The shards before the reshard in progress, empty when there is none
+prev_shard_count = {}
 
+# The view and shard tables above are never changed in place. Every change
+# builds a new copy under this lock and swaps it in, so a reader holding a
+# table always sees it whole, without taking any lock.
+table_lock = threading.Lock()
+
+# Number of views probed at the same time every round
+probe_fanout = 3
+# Time a view has to answer a probe (seconds)
+probe_timeout = 0.3
+# Number of other views asked to probe a view that didn't answer
+indirect_probes = 3
+# Time a suspected view has to prove it is alive before it is declared dead (seconds)
+suspect_timeout = 1.5
+# Every update is piggybacked this many times log(number of views)
+retransmit_mult = 3
+# Most updates piggybacked on one message
+piggyback_max = 20
+
+ALIVE = 'alive'
+SUSPECT = 'suspect'
+DEAD = 'dead'
+
+# view -> [state, incarnation, time it was suspected]
+members = {}
+# Incarnation of this view, only it can raise it. Starting from the clock means
+# a restarted view overrides whatever was said about it before it went down.
+incarnation = int(time.time() * 1000)
+# view -> [state, incarnation, number of times it was sent] of the news to spread
+updates = {}
+# Views left to probe this cycle, in random order
+probe_order = []
+gossip_lock = threading.Lock()
 
 
 """
-Verify that all views in the list are active
+Membership of the views, SWIM style
 
-Sends a GET request to each view every 'sleep_time' seconds to check if the view
-is alive.
-Also calls broadcast_dead_views() with the remaining views and the dead ones to broadcast
-the views that are no longer accessible
-This should be run in a separate thread so it doesn't interfere with anything else
+Every 'sleep_time' seconds the next 'probe_fanout' views (going round all of
+them in a random order) are probed at the same time. A view that doesn't answer
+within 'probe_timeout' is probed again through 'indirect_probes' other views,
+in case only the path between the two of them is broken. If none of them gets
+an answer either, the view is suspected and has 'suspect_timeout' seconds to
+prove it is alive (it hears about the suspicion and answers with a higher
+incarnation), after which it is declared dead. Suspected and dead views are
+taken out of alive_views.
+
+Nothing is broadcast. Changes of state are piggybacked on the probes and their
+answers, every one of them a few times log(number of views), which spreads
+them to every view in a few rounds whatever the size of the cluster.
 
-Runs an infinite loop, loops through each view in each iteration of the inf loop,
-then runs the get. If it doesn't respond, then add that to a list of dead views,
-then broadcast the list of dead views to all remaining peers
+This should be run in a separate thread so it doesn't interfere with anything else
 """
 def verify_views():
     print("Thread started")
+    announce(curr_view, ALIVE, incarnation)
     while True:
         time.sleep(sleep_time)
-        dead_view_list = []
-        for view in known_views[:]:
-            try:
-                response = requests.get('http://{}/key-value-store-view'.format(view))
-                if response.status_code != 200:
-                    print("The view '{}' is no longer reachable!".format(view), file=sys.stderr)
-                    dead_view_list.append(view)
-                    if view in alive_views:
-                        alive_views.remove(view)
-                else:
-                    if view not in alive_views:
-                        alive_views.append(view)
-            except Exception as e:
-                # This means we were unable to connect, such as a timeout
-                print("The view '{}' is no longer reachable!".format(view), file=sys.stderr)
-                dead_view_list.append(view)
-                if view in alive_views:
-                    alive_views.remove(view)
+        try:
+            probe_round()
+        except Exception as e:
+            print("Could not probe the views: {}".format(e), file=sys.stderr)
+
+def probe_round():
+    futures = [aio.submit(probe(view)) for view in next_targets(probe_fanout)]
+    concurrent.futures.wait(futures)
+    now = time.monotonic()
+    with gossip_lock:
+        expired = [(view, member[1]) for view, member in members.items()
+                   if member[0] == SUSPECT and now - member[2] > suspect_timeout]
+    for view, inc in expired:
+        print("The view '{}' is no longer reachable!".format(view), file=sys.stderr)
+        apply_update(view, DEAD, inc)
+
+"""
+The next views to probe, going round all of them in a random order
+
+Dead views are probed too, so one that comes back (or was cut off for a
+while) hears that it was declared dead and can refute it.
+"""
+def next_targets(count):
+    global probe_order
+    with gossip_lock:
+        candidates = [view for view in known_views if view != curr_view]
+        targets = []
+        while len(targets) < min(count, len(candidates)):
+            if len(probe_order) == 0:
+                probe_order = random.sample(candidates, len(candidates))
+            view = probe_order.pop()
+            if view in candidates and view not in targets:
+                targets.append(view)
+        return targets
+
+async def probe(view):
+    if await ping(view):
+        return
+    helpers = [v for v in alive_views if v != view and v != curr_view]
+    helpers = random.sample(helpers, min(indirect_probes, len(helpers)))
+    answers = await asyncio.gather(*[ping_through(helper, view) for helper in helpers])
+    if any(answers):
+        return
+    with gossip_lock:
+        current = members.get(view, [ALIVE, 0, 0])
+    if current[0] == ALIVE:
+        apply_update(view, SUSPECT, current[1])
+
+# Send a ping to a view, returns whether it answered
+async def ping(view):
+    try:
+        response = await aio.request('PUT', view, '/gossip-ping', gossip_message(), timeout=probe_timeout, probe=True)
+        if response.status_code != 200:
+            return False
+        receive(node_client.load(response))
+        return True
+    except Exception as e:
+        return False
+
+# Ask 'helper' to ping 'view', returns whether view answered it
+async def ping_through(helper, view):
+    payload = gossip_message()
+    payload['target'] = view
+    try:
+        response = await aio.request('PUT', helper, '/gossip-ping-req', payload, timeout=2 * probe_timeout, probe=True)
+        if response.status_code != 200:
+            return False
+        answer = node_client.load(response)
+        receive(answer)
+        return answer['ack']
+    except Exception as e:
+        return False
+
+# Handle a ping, the answer carries our own news
+def handle_ping(message):
+    receive(message)
+    return gossip_message()
+
+# Handle a request to ping another view for the sender
+def handle_ping_req(message):
+    receive(message)
+    answer = gossip_message()
+    answer['ack'] = aio.submit(ping(message['target'])).result()
+    return answer
+
+# The message sent with every ping and answer: who we are and the news to spread
+def gossip_message():
+    limit = retransmit_mult * max(1, math.ceil(math.log2(len(known_views) + 1)))
+    with gossip_lock:
+        news = sorted(updates.items(), key=lambda item: item[1][2])[:piggyback_max]
+        for view, update in news:
+            update[2] += 1
+            if update[2] >= limit:
+                del updates[view]
+        return {'from': curr_view, 'incarnation': incarnation,
+                'updates': [[view, update[0], update[1]] for view, update in news]}
+
+def receive(message):
+    # The sender is alive, it just sent something
+    sender = message['from']
+    if not apply_update(sender, ALIVE, message['incarnation']):
+        with gossip_lock:
+            current = members.get(sender)
+        if current is not None and current[0] != ALIVE:
+            # Tell it what we think of it, so it refutes it
+            announce(sender, current[0], current[1])
+    for view, state, inc in message.get('updates', []):
+        apply_update(view, state, inc)
+
+def announce(view, state, inc):
+    with gossip_lock:
+        updates[view] = [state, inc, 0]
+
+"""
+Apply what was heard about a view, if it is news
+
+The higher incarnation wins. For the same incarnation dead beats suspect, which
+beats alive. News about this view other than alive is refuted by raising our
+incarnation past it. News is spread further, stale news isn't. Returns whether
+it was news.
+"""
+def apply_update(view, state, inc):
+    global incarnation
+    if view == curr_view:
+        if state != ALIVE and inc >= incarnation:
+            with gossip_lock:
+                incarnation = inc + 1
+            announce(curr_view, ALIVE, incarnation)
+        return False
+    if view not in known_views:
+        return False
+    rank = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+    with gossip_lock:
+        current = members.get(view, [ALIVE, 0, 0])
+        if inc < current[1] or (inc == current[1] and rank[state] <= rank[current[0]]):
+            return False
+        members[view] = [state, inc, time.monotonic()]
+    if state == SUSPECT:
+        print("The view '{}' is suspected to be down".format(view), file=sys.stderr)
+    mark_alive(view, state == ALIVE)
+    announce(view, state, inc)
+    return True
+
+# The state of every view as this view sees it
+def membership():
+    with gossip_lock:
+        table = {view: {'state': members.get(view, [ALIVE, 0])[0], 'incarnation': members.get(view, [ALIVE, 0])[1]}
+                 for view in known_views if view != curr_view}
+    table[curr_view] = {'state': ALIVE, 'incarnation': incarnation}
+    return table
+
+# Add a view to the known (and alive) views, returns False if it was already known
+def add_view(view):
+    global known_views, alive_views
+    with table_lock:
+        if view in known_views:
+            return False
+        known_views = known_views + [view]
+        if view not in alive_views:
+            alive_views = alive_views + [view]
+        return True
+
+# Forget a view, returns False if it wasn't known
+def remove_view(view):
+    global known_views
+    with table_lock:
+        if view not in known_views:
+            return False
+        known_views = [v for v in known_views if v != view]
+        return True
+
+def mark_alive(view, alive):
+    global alive_views
+    with table_lock:
+        if alive and view not in alive_views:
+            alive_views = alive_views + [view]
+        elif not alive and view in alive_views:
+            alive_views = [v for v in alive_views if v != view]
 
 """
 Propagate a new view to all other views
@@ -73,7 +278,7 @@ def send_new(new_view):
             continue
         payload = {'socket-address': new_view}
         try:
-            response = requests.put( 'http://' + old_view + '/key-value-store-view', headers=HEADERS, data=json.dumps(payload))
+            response = node_client.put(old_view, '/key-value-store-view', payload)
         except:
             pass
 
@@ -84,6 +289,7 @@ def send_new(new_view):
 def verify_shards(shards):
     global shard_count
     if(shards > len(shard_count)):
+        new_count = {}
         for i in range(1,shards+1):
             #testing
             #if i == 1:
@@ -91,7 +297,9 @@ def verify_shards(shards):
                 #shard_count[i].append(100)
             #else:
             #shard_count[i] = [i]
-            shard_count[i] = []
+            new_count[i] = []
+        with table_lock:
+            shard_count = new_count
         ret_mess = "Shard count now = ", len(shard_count), ", array is: ", shard_count
         return ret_mess
     else:
@@ -117,13 +325,24 @@ def add_to_Shard(node):
     print("length of the shards",shard_len_array,"min_index = ", min_index)
 
     #add the node to the shard
-    shard_count[min_index].append(node)
+    add_shard_member(min_index, node)
     print("added the node to the smallest shard", shard_count)
     if node == curr_view:
         global curr_shard
         print("Curr shard has been set")
         curr_shard = min_index
 
+# Add a node to a shard, returns False if the shard doesn't exist
+def add_shard_member(shard, node):
+    global shard_count
+    with table_lock:
+        if shard not in shard_count:
+            return False
+        new_count = dict(shard_count)
+        new_count[shard] = shard_count[shard] + [node]
+        shard_count = new_count
+        return True
+
 #returns array of all the members in a shard
 def shard_members(shard):
     nodes = []
@@ -139,10 +358,52 @@ def im_new():
             continue
         payload = {'socket-address': curr_view}
         try:
-            response = requests.put( 'http://' + old_view + '/key-value-store-view-new', headers=HEADERS, data=json.dumps(payload), timeout=3)
+            response = node_client.put(old_view, '/key-value-store-view-new', payload, timeout=3)
         except:
             pass
 
 def update_shard(new_shard):
     global curr_shard
-    curr_shard = int(new_shard)
\ No newline at end of file
+    curr_shard = int(new_shard)
+
+"""
+Spread the known views over 'count' shards, moving as few of them as possible
+
+Every shard keeps as many of its current members as its share allows, then the
+views left over fill the shards that are still short. Returns the new layout.
+"""
+def plan_layout(count):
+    sizes = [len(known_views) // count for i in range(count)]
+    for i in range(len(known_views) % count):
+        sizes[i] += 1
+    layout = {}
+    assigned = set()
+    for i in range(count):
+        kept = [view for view in shard_count.get(i + 1, []) if view in known_views][:sizes[i]]
+        layout[i + 1] = kept
+        assigned.update(kept)
+    leftover = [view for view in known_views if view not in assigned]
+    for i in range(count):
+        while len(layout[i + 1]) < sizes[i]:
+            layout[i + 1].append(leftover.pop(0))
+    return layout
+
+"""
+Switch to a new shard layout while resharding
+
+The previous layout is kept in prev_shard_count until the keys are migrated,
+so the keys that haven't arrived yet can still be found.
+"""
+def apply_layout(new_layout, prev_layout):
+    global shard_count, prev_shard_count, curr_shard
+    with table_lock:
+        prev_shard_count = prev_layout
+        shard_count = new_layout
+        for shard, members in new_layout.items():
+            if curr_view in members:
+                curr_shard = shard
+
+def finish_layout():
+    global prev_shard_count
+    with table_lock:
+        prev_shard_count = {}
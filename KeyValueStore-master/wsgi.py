@@ -0,0 +1,5 @@
+import main
+
+# Entry point for WSGI servers, a node must run as a single process:
+#   gunicorn --workers 1 --worker-class gthread --threads 32 --bind <address> wsgi:app
+app = main.bootstrap()